@@ -36,6 +36,8 @@
 
 import sys
 import os
+import itertools
+from collections import Counter
 import gff3
 import psl
 from lib import mgiadhoc as db
@@ -99,24 +101,28 @@ class MgiComputedMerger:
                 self.mgi2feats[mgiid] = [ feat ]
 
     def loadPslFile(self):
-        # Each PSL line is parsed and turned into a gff3 feature hierarchy (match->match_part*)
-        # Here we iterate over the model roots (matches); the match_parts dangle below (f.children)
-        self.counts = {}
-        for m in gff3.models(psl.toGff(self.pslFile)):
-            # 
-            seqid = m.qName.split(DOT)[0]       # get the seqid w/o version number
-            mgiid = self.seqid2gene[seqid]      # lookup the corresponding mgiid
-            mfeats = self.mgi2feats[mgiid]      # list containing the gene followed by its match features
-            if m.pctLength < MIN_PCT_LENGTH:
-                self.logRejects(
-                    "REJECTING SEQUENCE (%s) for GENE (%s) - pctLength (%1.2f) less than minimum (%1.2f)"
-                    % (seqid,mgiid,m.pctLength,MIN_PCT_LENGTH))
-                self.logRejects(str(m))
-                continue
-            mfeats.append(m)
-            self.counts[seqid] = self.counts.setdefault(seqid, 0) + 1
+        # The PSL file is read by column (psl.Table), and the filters work a column at a time.
+        # The gff3 feature hierarchy (match->match_part*) is only built for alignments that are
+        # logged or output (see psl.Table.toGff).
+        t = self.psl = psl.Table(self.pslFile)
+        self.seqids = [ q.split(DOT)[0] for q in t.qName ]             # seqids w/o version numbers
+        genes = [ self.seqid2gene[s] for s in self.seqids ]              # the corresponding mgiids
+        self.chrs = [ c.replace("chr","") for c in t.tName ]             # e.g., "chr5" -> "5"
+        pctLength = t.percentLength()
+        passed = [ p >= MIN_PCT_LENGTH for p in pctLength ]
+        for i in itertools.compress(range(len(t)), [ not p for p in passed ]):
+            self.logRejects(
+                "REJECTING SEQUENCE (%s) for GENE (%s) - pctLength (%1.2f) less than minimum (%1.2f)"
+                % (self.seqids[i],genes[i],pctLength[i],MIN_PCT_LENGTH))
+            self.logRejects(str(t.toGff(i)))
+        # group the remaining alignments (row numbers, in file order) by gene, and count them by seqid
+        rows = list(itertools.compress(range(len(t)), passed))
+        self.counts = Counter([ self.seqids[i] for i in rows ])
+        self.mgi2rows = {}
+        for i in rows:
+            self.mgi2rows.setdefault(genes[i], []).append(i)
 
-    def loadMirbaseIDs (self) :
+    def loadMirbaseIDs (self, con=None) :
         # query to return all MGIid/miRBaseid pairs. We need this to fill in column 8 for the C4AM output file. 
         q = '''
         SELECT ra.accid as mirbase, ma.accid as mgiid
@@ -129,10 +135,10 @@ class MgiComputedMerger:
         AND ma._logicaldb_key = 1
         AND ma.preferred = 1
         '''
-        for r in db.sql(q):
-            self.mgi2mirbase.setdefault(r['mgiid'], []).append(r['mirbase'])
+        for mirbase, mgiid in db.copy(q, con):
+            self.mgi2mirbase.setdefault(mgiid, []).append(mirbase)
 
-    def loadCurrentCoordinates (self) :
+    def loadCurrentCoordinates (self, con=None) :
         q = '''
             SELECT a.accid as "mgiid", m.symbol, mc.chromosome as "chr", f.startcoordinate as "start", f.endcoordinate as "end", f.strand
             FROM
@@ -152,22 +158,19 @@ class MgiComputedMerger:
             AND a._logicaldb_key = 1
             AND a.preferred = 1
         ''' % MAP_COLLECTION_NAME
-        for r in db.sql(q) :
-            self.mgi2current[r['mgiid']] = gff3.Feature([
-                r['chr'],
+        for mgiid, symbol, chr, start, end, strand in db.iterate(q, con) :
+            self.mgi2current[mgiid] = gff3.Feature([
+                chr,
                 'mgi',
                 '.',
-                int(r['start']),
-                int(r['end']),
+                int(start),
+                int(end),
                 '.',
-                DOT if r['strand'] is None else r['strand'],
+                DOT if strand is None else strand,
                 '.',
-                { 'curie': r['mgiid'], 'Name': r['symbol'] }
+                { 'curie': mgiid, 'Name': symbol }
             ])
 
-    def qNameNoVersion (self, f) :
-        return f.qName.split(DOT)[0] 
-
     def logRejects (self, msg, rejects = None, sep=NL) :
         self.log(msg)
         if rejects and len(rejects) > 0:
@@ -175,27 +178,28 @@ class MgiComputedMerger:
         self.log(NL)
         
     def processAlignments (self) :    
+        t = self.psl
+        qNames = lambda rows: set([ t.qName[i] for i in rows ])
         for mgiid, mfeats in list(self.mgi2feats.items()):
             # the top-level mgi feature
             mf = mfeats[0]
+            rows = self.mgi2rows.get(mgiid, [])
             # throw out mult matches for the same seqid (ie only keep single matches)
-            singles = [m for m in mfeats[1:] if self.counts[self.qNameNoVersion(m)] == 1]
-            multiples = [m for m in mfeats[1:] if self.counts[self.qNameNoVersion(m)] > 1]
+            singles = [i for i in rows if self.counts[self.seqids[i]] == 1]
+            multiples = [i for i in rows if self.counts[self.seqids[i]] > 1]
             if len(multiples) :
                 self.logRejects(
                     "REJECTING SEQUENCES for GENE (%s) - multiple matches per sequence: %s" 
-                    % (mgiid, set([ m.qName for m in multiples ])))
+                    % (mgiid, qNames(multiples)))
             # Remove single best hits to chromosome different from mgi genetic chromosome.
             ss = []
-            for m in singles:
-                # chromosome: replace "chr5" for example with just "5"
-                m.seqid = m.seqid.replace("chr","")
-                if m.seqid != mf.seqid and mf.seqid != "UN":
+            for i in singles:
+                if self.chrs[i] != mf.seqid and mf.seqid != "UN":
                     self.logRejects(
                         "REJECTING SEQUENCE (%s) for GENE (%s) - matches to different chromosome (%s) than MGI genetic chromosome (%s)"
-                        % (m.qName,mgiid,m.seqid,mf.seqid))
+                        % (t.qName[i],mgiid,self.chrs[i],mf.seqid))
                 else:
-                    ss.append(m)
+                    ss.append(i)
             singles = ss
 
             # if no single matches, reject the gene
@@ -212,11 +216,11 @@ class MgiComputedMerger:
                 continue
 
             # if singles do not all agree on chromosome, reject the gene
-            chroms = set([ s.seqid for s in singles ])
+            chroms = set([ self.chrs[i] for i in singles ])
             if len(chroms) > 1:
                 self.logRejects(
                     "REJECTING GENE (%s) - Sequences match to multiple chromosomes: %s "
-                    % (mgiid, set([ m.qName for m in singles ])))
+                    % (mgiid, qNames(singles)))
                 mf._rejected = True
                 continue
 
@@ -225,29 +229,20 @@ class MgiComputedMerger:
                 mf.seqid = list(chroms)[0]
                 self.log("ASSIGNING CHROMOSOME (%s) to gene (%s) - was UN.\n" % (mf.seqid, mgiid))
 
-            # tweak the models
-            for s in singles:
-                for ss in gff3.flattenModel(s):
-                    ss.seqid = ss.seqid.replace("chr","")
-                    # tag with the MGI#
-                    ss.mgi_id = mgiid
-                # Attach the match feature to the gene
-                s.Parent = [ mf.ID ]
-
             # Divide into DNA and RNA and EST matches
             rnaSingles = []
             estSingles = []
             dnaSingles = []
-            for s in singles:
-              seqid = self.qNameNoVersion(s)
+            for i in singles:
+              seqid = self.seqids[i]
               tp = self.seqid2type[seqid]
               dv = self.seqid2div[seqid]
               if tp == "RNA" and dv == "EST":
-                estSingles.append(s)
+                estSingles.append(i)
               elif tp == "RNA" and dv != "EST":
-                rnaSingles.append(s)
+                rnaSingles.append(i)
               else:
-                dnaSingles.append(s)
+                dnaSingles.append(i)
               
             # If gene has RNA matches:
             #   - ignore DNA and EST matches
@@ -264,29 +259,35 @@ class MgiComputedMerger:
             #   - do not infer strand for gene - all strands should be set to "."
 
             if len(rnaSingles) > 0 :
-                strands = set([ s.strand for s in rnaSingles ])
+                strands = set([ t.strand[i] for i in rnaSingles ])
                 if len(strands) > 1 :
                     self.logRejects(
                         "REJECTING GENE (%s) - RNA sequences match to both strands: %s"
-                        % (mgiid, set([r.qName for r in rnaSingles])))
+                        % (mgiid, qNames(rnaSingles)))
                     mf._rejected = True
                     continue
                 mf.strand = list(strands)[0]
-                mfeats[1:] = rnaSingles
+                matches = rnaSingles
             elif len(estSingles) > 0 :
                 self.log("GENE (%s) - only has EST%s matches. Setting strand to '.'\n" % (mgiid, " and DNA" if len(dnaSingles) else ''))
                 mf.strand = DOT
-                for ff in estSingles:
-                  for fff in gff3.flattenModel(ff):
-                      fff.strand = DOT
-                mfeats[1:] = estSingles
+                matches = estSingles
             else:
                 self.log("GENE (%s) - only has DNA matches. Setting strand to '.'\n" % mgiid)
                 mf.strand = DOT
-                for ff in dnaSingles:
-                  for fff in gff3.flattenModel(ff):
-                      fff.strand = DOT
-                mfeats[1:] = dnaSingles
+                matches = dnaSingles
+
+            # build the models
+            mfeats[1:] = [ t.toGff(i) for i in matches ]
+            for s in mfeats[1:]:
+                for ss in gff3.flattenModel(s):
+                    ss.seqid = ss.seqid.replace("chr","")
+                    # tag with the MGI#
+                    ss.mgi_id = mgiid
+                    if mf.strand == DOT:
+                        ss.strand = DOT
+                # Attach the match feature to the gene
+                s.Parent = [ mf.ID ]
 
             # Update the gene-level feature
             mf.seqid = list(chroms)[0]
@@ -295,11 +296,7 @@ class MgiComputedMerger:
 
     def output (self) :
         def topLevelKey (fs) :
-            s = fs[0].seqid
-            ss = fs[0].start
-            if len(s) == 1 and s.isdigit():
-                s = "0" + s
-            return (s, ss)
+            return gff3.sortKey(fs[0])
         self.gffofd = open(self.outGffFile, 'w')
         self.c4amOfd = open(self.outC4amFile, 'w')
         self.c4amOfd.write('build=%s\n' % BUILD)
@@ -411,10 +408,12 @@ class MgiComputedMerger:
                 self.c4amOfd.write(prefix + TAB.join(r)+NL)
 
     def main(self):
-        self.loadCurrentCoordinates()
+        # The queries run (in threads, on separate connections) while the files are read.
+        queries = [ db.submit(self.loadCurrentCoordinates), db.submit(self.loadMirbaseIDs) ]
         self.loadSeqidFile()
-        self.loadMirbaseIDs()
         self.loadPslFile()
+        for q in queries:
+            q.result()
         self.processAlignments()
         self.output()
 
@@ -19,8 +19,14 @@
 #       name    The gene's name
 #       mcvtype The gene's MCV type
 #       sotype  The gene's SO type
+#
+# The MGI ids of genes that already have models are read from stdin. They are loaded into a
+# temporary table, and the query leaves those genes out (an anti-join), so only the rows for
+# genes that need blat come back.
 
 import sys
+import io
+import hashlib
 from lib import mgiadhoc as db
 from lib import mcv2so
 
@@ -57,6 +63,7 @@ seqsWithOneGene = '''
 # - if type = DNA, then length <= 10 kb
 # - not low quality
 # - not in problem alignment set
+# - gene does not already have a model (not in the genes_with_models temp table)
 sequences = '''
   SELECT distinct
       c.accid as sequenceid,
@@ -98,24 +105,40 @@ sequences = '''
       SELECT _object_key
       FROM MGI_SetMember
       WHERE _Set_key = 1058)
+  /* gene does not already have a model */
+  AND NOT EXISTS (
+      SELECT 1
+      FROM genes_with_models g
+      WHERE g.mgiid = a.accid)
   ''' % (genes, seqsWithOneGene)
 
-genesWithModels = set([ mid.strip() for mid in sys.stdin ])
+# Loads the MGI ids into the genes_with_models temp table (on connection con).
+def loadGenesWithModels (con, ids) :
+    cur = con.cursor()
+    cur.execute('CREATE TEMP TABLE genes_with_models (mgiid text)')
+    cur.copy_from(io.StringIO(''.join([i + '\n' for i in ids])), 'genes_with_models', columns=('mgiid',))
+    cur.execute('ANALYZE genes_with_models')
+    cur.close()
+
+genesWithModels = sorted(set([ mid.strip() for mid in sys.stdin if mid.strip() ]))
 
-for r in db.sql(sequences):
-    if r["markerid"] in genesWithModels:
-        continue
-    mcvtype = r["mcv_type"]
-    sotype  = mcv2so.mcv2so[mcvtype]
-    line = [
-      r["sequenceid"],
-      r["seq_type"],
-      r["division"],
-      r["markerid"],
-      r["symbol"],
-      r["name"],
-      mcvtype,
-      sotype,
-      r["chromosome"]
-    ]
-    print("\t".join(line))
+with db.pooledConnection() as con:
+    loadGenesWithModels(con, genesWithModels)
+    # The result depends on the temp table's contents, so they are part of the query text
+    # (and so of the key, if query results are cached).
+    digest = hashlib.sha1('\n'.join(genesWithModels).encode()).hexdigest()
+    q = sequences + '  /* genes_with_models: %d ids, sha1 %s */\n' % (len(genesWithModels), digest)
+    for sequenceid, seq_type, division, markerid, symbol, name, mcvtype, chromosome in db.iterate(q, con):
+        sotype  = mcv2so.mcv2so[mcvtype]
+        line = [
+            sequenceid,
+            seq_type,
+            division,
+            markerid,
+            symbol,
+            name,
+            mcvtype,
+            sotype,
+            chromosome
+        ]
+        print("\t".join(line))
@@ -1,6 +1,6 @@
-
 import sys
 import gff3
+import transform
 from OrderedSet import OrderedSet
 
 
@@ -16,41 +16,49 @@ EXCLUDE_TYPES = OrderedSet([
     "five_prime_UTR"
 ])
 
-filtFcn = lambda f: f.type not in EXCLUDE_TYPES and f.source not in EXCLUDE_SOURCES
-feats = filter(filtFcn, gff3.iterate(sys.stdin))
-for m in gff3.models(feats):
-    for f in gff3.flattenModel(m):
-        if f.attributes.get("ID","").startswith("transcript:"):
-            f.Name = f.transcript_id
-        f.source = "ENSEMBL"
-        if len(f.parents) == 0:
-            f.attributes["curie"] = "ENSEMBL:" + f.ID.split(":")[1]
-        biotype = f.attributes.get("biotype", None)
-        if biotype and len(f.parents) == 0:
-            if biotype == "protein_coding":
-                biotype = "protein_coding_gene"
-            f.attributes["so_term_name"] = biotype
-        f.attributes.pop("biotype", None)
-        f.attributes.pop("version", None)
-        f.attributes.pop("description", None)
-        f.attributes.pop("logic_name", None)
-        f.attributes.pop("gene_id", None)
-        f.attributes.pop("transcript_support_level", None)
-        f.attributes.pop("rank", None)
-        f.attributes.pop("constitutive", None)
-        f.attributes.pop("ensembl_end_phase", None)
-        f.attributes.pop("ensembl_phase", None)
-        if f.type == "CDS":
-            f.Name = f.protein_id
-        elif f.type == "lnc_RNA":
-            f.type = "lncRNA"
-        elif f.type == "miRNA" and len(f.children):
-            # Ensembl miRNA models look ike this:
-            #     gene -> miRNA -> exon
-            # However, the miRNA actually has the coordinates of the immature transcript.
-            # Here we change the type. Output models look like:
-            #     gene -> pre_miRNA -> exon
-            # FIXME: when Ensembl fixes their representations, revise this code.
-            f.type = "pre_miRNA"
-        sys.stdout.write(str(f))
+# Feature-level transforms (see lib/transform.py)
+RULES = {
+    "source" : "ENSEMBL",
+    "excludeTypes" : EXCLUDE_TYPES,
+    "excludeSources" : EXCLUDE_SOURCES,
+    "renameTypes" : { "lnc_RNA" : "lncRNA" },
+    "copyAttributes" : [
+        { "to" : "Name", "from" : "transcript_id", "idPrefix" : "transcript:" },
+        { "to" : "Name", "from" : "protein_id", "type" : "CDS" },
+    ],
+    "rootCurie" : { "from" : "ID", "pattern" : r"[^:]*:([^:]*)", "format" : "ENSEMBL:%s" },
+    "rootSoTerm" : { "from" : "biotype", "map" : { "protein_coding" : "protein_coding_gene" } },
+    "dropAttributes" : [
+        "biotype",
+        "version",
+        "description",
+        "logic_name",
+        "gene_id",
+        "transcript_support_level",
+        "rank",
+        "constitutive",
+        "ensembl_end_phase",
+        "ensembl_phase",
+    ],
+}
+
+TRANSFORMER = transform.compile(RULES)
+
+# Preps the Ensembl gff3 lines from inp, writing the models to out (a gff3.ModelSink).
+def prep(inp, out):
+    for m in gff3.models(TRANSFORMER.iterate(inp)):
+        feats = gff3.flattenModel(m)
+        for f in feats:
+            if f.type == "miRNA" and len(f.children):
+                # Ensembl miRNA models look ike this:
+                #     gene -> miRNA -> exon
+                # However, the miRNA actually has the coordinates of the immature transcript.
+                # Here we change the type. Output models look like:
+                #     gene -> pre_miRNA -> exon
+                # FIXME: when Ensembl fixes their representations, revise this code.
+                f.type = "pre_miRNA"
+        out.writeModel(feats)
 
+#
+if __name__ == "__main__":
+    prep(sys.stdin, gff3.ModelSink(sys.stdout))
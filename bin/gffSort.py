@@ -1,20 +1,38 @@
 #
 # gffSort.py
 #
+# Sorts models by chromosome (in CHRS order: 1..19, X, Y, MT), then by start
+# position of the top-level feature.
+#
 # Usage:
 #   python3 gffSort.py < input.gff > output.gff
+#       Reads and sorts all the models in the input.
+#   python3 gffSort.py input1.gff [input2.gff ...] > output.gff
+#       Each input file must already be sorted, in the same order (chromosomes
+#       in CHRS order; output of older versions of gffSort, which sorted
+#       chromosomes as strings, is not). The files are merged (streamed),
+#       rather than read into memory and sorted.
 #
 
 import sys
 from lib import gff3
 
-gffStream = gff3.iterate(sys.stdin, returnHeader=True, returnGroups=True)
-header = next(gffStream)
-allModels = list(gffStream)
-# sort by models by chromosome, then start position of the top-level feature
-allModels.sort(key = lambda m: (m[0][0], m[0][3]))
+def groupKey (g) :
+    return gff3.sortKey(g[0])
+
+def groups (source) :
+    gffStream = gff3.iterate(source, returnHeader=True, returnGroups=True)
+    next(gffStream, None)       # skip the header
+    return gffStream
+
+if len(sys.argv) > 1:
+    allModels = gff3.merge(*[groups(fname) for fname in sys.argv[1:]], key=groupKey)
+else:
+    allModels = list(groups(sys.stdin))
+    # sort by models by chromosome, then start position of the top-level feature
+    allModels.sort(key = groupKey)
+
 for model in allModels:
     for f in model:
         print(gff3.format(f), end='')
     print('###')
-
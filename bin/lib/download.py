@@ -0,0 +1,335 @@
+#
+# download.py
+#
+# Downloads a (large) file over HTTP in concurrent byte-range segments.
+#
+# The file is written to DEST.part, and progress is recorded in a journal, DEST.journal
+# (JSON: url, size, ETag/Last-Modified, and for each segment its range and the number of
+# bytes done). Each segment is retried (NTRIES times, with a growing pause) from where it
+# left off. If the download is interrupted, running it again resumes from the journal,
+# provided the file on the server has not changed (same size and ETag/Last-Modified).
+# When all segments are done, the size is checked, and the checksum too, if one is given
+# (as ALGORITHM:HEXDIGEST, or by the url of an md5sum-style checksums file, such as NCBI's
+# md5checksums.txt). Then DEST.part is renamed to DEST and the journal is removed.
+#
+# If the server does not support Range requests (or for non-HTTP urls, e.g. ftp), the file
+# is downloaded as a single stream.
+#
+# The file's url, size, ETag and Last-Modified are saved in DEST.meta (JSON). With -i, if DEST
+# and DEST.meta exist, the server is first asked (by a conditional request, If-None-Match /
+# If-Modified-Since) whether the file has changed, and it is only downloaded if so.
+#
+# For files fetched some other way (e.g. streamed by prepAll.py, which saves the raw bytes), -n
+# just tells (by exit status) whether DEST is current, and -a verifies DEST as above (size and
+# checksum) and writes DEST.meta, without downloading.
+#
+# Usage:
+#       $ python download.py [-i] [-s NSEGMENTS] [-c ALGORITHM:HEXDIGEST] [-m CHECKSUMSURL] url dest
+#       $ python download.py -n url dest
+#       $ python download.py -a [-c ALGORITHM:HEXDIGEST] [-m CHECKSUMSURL] url dest
+#
+#       In code:
+#       download.download(url, dest, nSegments=4)
+#
+
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.request
+import urllib.parse
+import urllib.error
+
+NSEGMENTS = 4
+NTRIES = 4
+SLEEPTIME = 3
+BLOCKSIZE = 1024 * 1024
+# The journal is saved after every this many bytes (per segment)
+SAVEEVERY = 16 * BLOCKSIZE
+
+class DownloadError(RuntimeError):
+    pass
+
+#----------------------------------------------------
+# Returns the metadata for url, from a HEAD request: a dict with url, size (None if unknown),
+# ranges (whether Range requests are accepted), etag and lastModified (None if not given).
+#
+def probeMeta(url):
+    meta = { "url" : url, "size" : None, "ranges" : False, "etag" : None, "lastModified" : None }
+    if not url.startswith("http"):
+        return meta
+    req = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(req) as resp:
+        size = resp.headers.get("Content-Length", None)
+        meta["size"] = int(size) if size is not None else None
+        meta["ranges"] = resp.headers.get("Accept-Ranges", "none").lower() == "bytes"
+        meta["etag"] = resp.headers.get("ETag", None)
+        meta["lastModified"] = resp.headers.get("Last-Modified", None)
+    return meta
+
+# Returns (size, accepts ranges, validator) for url. The validator is the ETag, or Last-Modified, or None.
+def probe(url):
+    meta = probeMeta(url)
+    return (meta["size"], meta["ranges"], meta["etag"] or meta["lastModified"])
+
+#----------------------------------------------------
+# Returns True if the file at url is known to be unchanged since meta (see probeMeta) was taken.
+# Asks the server with a conditional HEAD request (If-None-Match / If-Modified-Since). Some servers
+# ignore the conditions on HEAD, so a 200 whose validators match meta also counts as unchanged.
+# Returns False if there is nothing to compare (e.g. ftp urls), or the server cannot be reached.
+#
+def notModified(url, meta):
+    if not url.startswith("http") or not meta or meta.get("url") != url:
+        return False
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("lastModified"):
+        headers["If-Modified-Since"] = meta["lastModified"]
+    if not headers:
+        return False
+    req = urllib.request.Request(url, method="HEAD", headers=headers)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            etag = resp.headers.get("ETag", None)
+            lastModified = resp.headers.get("Last-Modified", None)
+            return (etag or lastModified) is not None \
+                and etag == meta.get("etag") and lastModified == meta.get("lastModified")
+    except urllib.error.HTTPError as e:
+        return e.code == 304
+    except Exception as e:
+        sys.stderr.write("Could not check %s (%s).\n" % (url, e))
+        return False
+
+# Reads/writes the metadata file for a downloaded file.
+def readMeta(dest):
+    try:
+        with open(dest + ".meta") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+def writeMeta(dest, meta):
+    with open(dest + ".meta", 'w') as fd:
+        json.dump(meta, fd)
+
+#----------------------------------------------------
+# Downloads url to dest. See above.
+#
+class Downloader:
+    def __init__(self, url, dest, nSegments=NSEGMENTS, checksum=None, log=None):
+        self.url = url
+        self.dest = dest
+        self.part = dest + ".part"
+        self.journalFile = dest + ".journal"
+        self.meta = None
+        self.nSegments = max(1, nSegments)
+        self.checksum = checksum
+        self.log = log or sys.stderr.write
+        self.lock = threading.Lock()
+        self.journal = None
+        self.errors = []
+
+    # Loads the journal, if there is one for this url, size and validator. Otherwise starts a new one.
+    def loadJournal(self, size, validator):
+        if os.path.exists(self.journalFile) and os.path.exists(self.part):
+            with open(self.journalFile) as fd:
+                j = json.load(fd)
+            if j["url"] == self.url and j["size"] == size and j["validator"] == validator:
+                done = sum([s[2] for s in j["segments"]])
+                self.log("Resuming download of %s: %d of %d bytes done.\n" % (self.url, done, size))
+                return j
+        segSize = -(-size // self.nSegments)
+        segs = [[start, min(start + segSize, size) - 1, 0] for start in range(0, size, segSize)]
+        with open(self.part, 'wb') as fd:
+            fd.truncate(size)
+        return { "url" : self.url, "size" : size, "validator" : validator, "segments" : segs }
+
+    def saveJournal(self):
+        with self.lock:
+            tmp = self.journalFile + ".tmp"
+            with open(tmp, 'w') as fd:
+                json.dump(self.journal, fd)
+            os.replace(tmp, self.journalFile)
+
+    # Fetches one segment (retrying as needed).
+    def fetchSegment(self, seg):
+        for i in range(NTRIES):
+            try:
+                self._fetchSegment(seg)
+                return
+            except Exception as e:
+                self.log("Segment %d-%d of %s failed (%s). Try %d of %d.\n" % (seg[0], seg[1], self.url, e, i+1, NTRIES))
+                self.saveJournal()
+                if i < NTRIES - 1:
+                    time.sleep(SLEEPTIME * (i + 1))
+        self.errors.append(seg)
+
+    def _fetchSegment(self, seg):
+        start, end = seg[0], seg[1]
+        if start + seg[2] > end:
+            return
+        req = urllib.request.Request(self.url, headers={ "Range" : "bytes=%d-%d" % (start + seg[2], end) })
+        fd = os.open(self.part, os.O_WRONLY)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                if resp.status != 206:
+                    raise DownloadError("Range request not honored (status %d)" % resp.status)
+                unsaved = 0
+                while start + seg[2] <= end:
+                    data = resp.read(min(BLOCKSIZE, end - start - seg[2] + 1))
+                    if not data:
+                        raise DownloadError("Connection closed early")
+                    os.pwrite(fd, data, start + seg[2])
+                    seg[2] += len(data)
+                    unsaved += len(data)
+                    if unsaved >= SAVEEVERY:
+                        self.saveJournal()
+                        unsaved = 0
+        finally:
+            os.close(fd)
+
+    # Downloads as a single stream (no ranges).
+    def fetchWhole(self):
+        for i in range(NTRIES):
+            try:
+                with urllib.request.urlopen(self.url) as resp, open(self.part, 'wb') as fd:
+                    while True:
+                        data = resp.read(BLOCKSIZE)
+                        if not data:
+                            break
+                        fd.write(data)
+                return
+            except Exception as e:
+                self.log("Download of %s failed (%s). Try %d of %d.\n" % (self.url, e, i+1, NTRIES))
+                if i < NTRIES - 1:
+                    time.sleep(SLEEPTIME * (i + 1))
+        raise DownloadError("Download of %s failed." % self.url)
+
+    # Checks the downloaded file's (or path's) size and checksum.
+    def verify(self, size, path=None):
+        path = path or self.part
+        if size is not None and os.path.getsize(path) != size:
+            raise DownloadError("Size mismatch for %s: expected %d, got %d" % (self.url, size, os.path.getsize(path)))
+        if self.checksum:
+            algorithm, expected = self.checksum.split(":", 1)
+            h = hashlib.new(algorithm)
+            with open(path, 'rb') as fd:
+                for block in iter(lambda: fd.read(BLOCKSIZE), b''):
+                    h.update(block)
+            if h.hexdigest().lower() != expected.lower():
+                raise DownloadError("Checksum mismatch for %s: expected %s, got %s" % (self.url, expected, h.hexdigest()))
+
+    # Returns True if dest was downloaded before (from the same url) and the server says it is unchanged.
+    def isCurrent(self):
+        if not os.path.exists(self.dest) or not notModified(self.url, readMeta(self.dest)):
+            return False
+        self.log("Not modified since last download: %s (%s)\n" % (self.url, self.dest))
+        return True
+
+    # Checks a copy of the file fetched some other way (e.g. saved by prepAll.py -k), already at
+    # dest, against the server's size and the checksum, and records its metadata (so that isCurrent
+    # works for it). Raises DownloadError if it does not match.
+    def adopt(self):
+        if not os.path.exists(self.dest):
+            raise DownloadError("No such file: %s" % self.dest)
+        try:
+            meta = probeMeta(self.url)
+        except Exception as e:
+            raise DownloadError("Could not probe %s (%s)." % (self.url, e))
+        self.verify(meta["size"], self.dest)
+        meta["size"] = os.path.getsize(self.dest)
+        writeMeta(self.dest, meta)
+        self.log("Verified %s as a download of %s (%d bytes).\n" % (self.dest, self.url, meta["size"]))
+
+    def run(self):
+        try:
+            self.meta = probeMeta(self.url)
+        except Exception as e:
+            self.log("Could not probe %s (%s). Downloading as one stream.\n" % (self.url, e))
+            self.meta = { "url" : self.url, "size" : None, "ranges" : False, "etag" : None, "lastModified" : None }
+        size, ranges = self.meta["size"], self.meta["ranges"]
+        validator = self.meta["etag"] or self.meta["lastModified"]
+        if size is None or not ranges or size == 0:
+            self.fetchWhole()
+        else:
+            self.journal = self.loadJournal(size, validator)
+            self.saveJournal()
+            threads = [threading.Thread(target=self.fetchSegment, args=(seg,)) for seg in self.journal["segments"]]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            self.saveJournal()
+            if self.errors:
+                raise DownloadError("Download of %s incomplete (%d segments failed). Run again to resume." % (self.url, len(self.errors)))
+        self.verify(size)
+        os.replace(self.part, self.dest)
+        if os.path.exists(self.journalFile):
+            os.remove(self.journalFile)
+        self.meta["size"] = os.path.getsize(self.dest)
+        writeMeta(self.dest, self.meta)
+        self.log("Downloaded %s to %s (%d bytes).\n" % (self.url, self.dest, os.path.getsize(self.dest)))
+
+#----------------------------------------------------
+# Returns the checksum ("md5:HEX") for file url from an md5sum-style checksums file
+# (lines of: hexdigest, whitespace, file name), or None if it is not listed (or the
+# checksums file cannot be read).
+#
+def checksumFromFile(checksumsUrl, url):
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    try:
+        with urllib.request.urlopen(checksumsUrl) as resp:
+            lines = resp.read().decode().splitlines()
+    except Exception as e:
+        sys.stderr.write("Could not get checksums from %s (%s).\n" % (checksumsUrl, e))
+        return None
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 2 and os.path.basename(parts[1]) == name:
+            return "md5:" + parts[0]
+    return None
+
+#----------------------------------------------------
+# Downloads url to dest. See Downloader. If ifModified is True, and dest is from an earlier
+# download of url that the server says is still current, does nothing. Returns True if
+# the file was downloaded.
+#
+def download(url, dest, nSegments=NSEGMENTS, checksum=None, log=None, ifModified=False):
+    d = Downloader(url, dest, nSegments, checksum, log)
+    if ifModified and d.isCurrent():
+        return False
+    d.run()
+    return True
+
+#----------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download a file in concurrent, resumable, byte-range segments.')
+    parser.add_argument('-s', '--segments', type=int, default=NSEGMENTS, help='number of segments')
+    parser.add_argument('-c', '--checksum', default=None, help='expected checksum, as ALGORITHM:HEXDIGEST')
+    parser.add_argument('-m', '--checksums', default=None, help='url of an md5sum-style checksums file listing the file')
+    parser.add_argument('-i', '--if-modified', dest='ifModified', action='store_true', default=False,
+        help='only download if the file has changed since it was last downloaded to dest')
+    parser.add_argument('-n', '--not-modified', dest='notModified', action='store_true', default=False,
+        help='download nothing; exit 0 if dest is current (see -i), 1 if not')
+    parser.add_argument('-a', '--adopt', action='store_true', default=False,
+        help='download nothing; verify the existing dest (size, checksum) and record its metadata')
+    parser.add_argument('url')
+    parser.add_argument('dest')
+    args = parser.parse_args()
+    d = Downloader(args.url, args.dest, args.segments, args.checksum)
+    if args.notModified:
+        sys.exit(0 if d.isCurrent() else 1)
+    if args.ifModified and d.isCurrent():
+        sys.exit(0)
+    if not d.checksum and args.checksums:
+        d.checksum = checksumFromFile(args.checksums, args.url)
+    try:
+        if args.adopt:
+            d.adopt()
+        else:
+            d.run()
+    except DownloadError as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
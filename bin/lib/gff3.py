@@ -68,6 +68,10 @@ import types
 import urllib.request, urllib.parse, urllib.error
 import itertools
 import heapq
+import io
+import multiprocessing
+import queue
+import traceback
 import re
 from OrderedSet import OrderedSet
 from io import IOBase
@@ -83,6 +87,9 @@ GROUPSEP = "###\n"
 # According to GFF spec, these predefined attributes support multiple values
 MULTIVALUED = set(["Parent", "Alias", "Note", "Dbxref", "Ontology_term"])
 
+# How often (seconds) prefetchModels checks that its reading process is still alive
+PREFETCH_POLL = 5
+
 #----------------------------------------------------
 HASH    = '#'
 TAB     = '\t'
@@ -393,6 +400,123 @@ def models(features, flatten=False, returnHeader=False):
         v = flattenModel(m) if flatten else m
         yield v
 
+#----------------------------------------------------
+# Compact, picklable form of a model: a list of plain 9-item lists, one per feature,
+# root first, parents before children (depth first, in child order). Features
+# shared by more than one parent appear once.
+#
+def packModel(m):
+    packed = []
+    seen = set()
+    def _(f):
+        if id(f) in seen:
+            return
+        seen.add(id(f))
+        packed.append(f[:])
+        for c in f.children:
+            _(c)
+    _(m)
+    return packed
+
+# Inverse of packModel. Returns the root feature, with the model hanging off it
+# (parents/children), in the same child order as the packed model.
+# Since packed features came from Features, they are not re-validated or copied
+# (which is what makes this cheaper than parsing the original lines).
+# Features are created and indexed first, then linked to their parents (a feature shared
+# by more than one parent is packed under the first, possibly before the others).
+def unpackModel(packed):
+    feats = []
+    id2feature = {}
+    for p in packed:
+        f = Feature.__new__(Feature)
+        list.__init__(f, p)
+        f.__dict__["parents"] = OrderedSet()
+        f.__dict__["children"] = OrderedSet()
+        if "ID" in p[8]:
+            id2feature[p[8]["ID"]] = f
+        feats.append(f)
+    for f in feats:
+        pids = f[8].get("Parent", [])
+        if type(pids) is str: pids = [pids]
+        for pid in pids:
+            parent = id2feature[pid]
+            f.parents.add(parent)
+            parent.children.add(f)
+    return feats[0] if feats else None
+
+#----------------------------------------------------
+# Parse-ahead version of models(). The features are read, parsed, and assembled
+# into models in a separate (forked) process, which sends them back in packed form
+# (see packModel) through a bounded queue, in batches of batchSize models, at most
+# maxBatches batches ahead of the consumer. The caller sees the same sequence of
+# models as models(source) would yield.
+# If stats (a dict) is given, whatever the reading process puts in it (e.g. counts kept
+# by a source generator) is copied back into it when reading is done.
+# Messages the reading process writes to stderr are passed back, and written by the caller
+# just before the model they preceded.
+# name (e.g. the file name) identifies the source in error messages. If the reading
+# process dies without reporting (e.g. killed), a RuntimeError is raised.
+#
+# Processes that cannot have children (e.g., multiprocessing.Pool workers) just get models(source).
+#
+def prefetchModels(source, batchSize=200, maxBatches=16, stats=None, name=None):
+    if multiprocessing.current_process().daemon:
+        yield from models(source)
+        return
+    name = name or "input"
+    ctx = multiprocessing.get_context("fork")
+    q = ctx.Queue(maxBatches)
+    p = ctx.Process(target=_prefetchWorker, args=(source, q, batchSize, stats), daemon=True)
+    p.start()
+    try:
+        while True:
+            try:
+                kind, data, msgs = q.get(timeout=PREFETCH_POLL)
+            except queue.Empty:
+                if not p.is_alive():
+                    raise RuntimeError("Error reading models from %s: reading process died (exit code %s)" % (name, p.exitcode))
+                continue
+            if kind == "models":
+                for m in data:
+                    sys.stderr.write(m[0])
+                    yield unpackModel(m[1])
+                continue
+            sys.stderr.write(msgs)
+            if kind == "error":
+                raise RuntimeError("Error reading models from %s:\n%s" % (name, data))
+            if stats is not None:
+                stats.update(data)
+            break
+        p.join()
+    finally:
+        if p.is_alive():
+            p.terminate()
+
+# Reads models from source and puts them in q, in batches: ("models", [(msgs, packed model), ...], "").
+# Ends with ("done", stats, msgs) or ("error", traceback, msgs). Anything written to stderr while
+# reading (e.g. by a source generator) is captured, and sent along with the next model (msgs),
+# so the consumer writes it in the same order as if it had read the models itself.
+def _prefetchWorker(source, q, batchSize, stats):
+    buf = io.StringIO()
+    sys.stderr = buf
+    def msgs():
+        text = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return text
+    try:
+        batch = []
+        for m in models(source):
+            batch.append((msgs(), packModel(m)))
+            if len(batch) == batchSize:
+                q.put(("models", batch, ""))
+                batch = []
+        if len(batch):
+            q.put(("models", batch, ""))
+        q.put(("done", stats if stats is not None else {}, msgs()))
+    except:
+        q.put(("error", traceback.format_exc(), msgs()))
+
 #----------------------------------------------------
 # walkModel - given the root feature of the model, yields its
 # elements in breadth-first order.
@@ -453,16 +577,65 @@ def copyModel(mfeats):
   crossReference(copy)
   return copy
 
+#----------------------------------------------------
+# The chromosomes and their order. (Same as CHRS in Configuration.)
+# Sequence ids not in the table sort after all those that are, in the
+# order in which they are first seen.
+#
+CHRS = "1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 X Y MT".split()
+
+# Builds a chromosome order table (seqid -> rank) from a list of chromosomes.
+def chrOrder(chrs=CHRS):
+    return dict([(c,i) for (i,c) in enumerate(chrs)])
+
+CHR_ORDER = chrOrder()
+
+#----------------------------------------------------
+# Returns an integer sort key for a feature: chromosome rank in the high
+# bits, start position in the low 32 bits. Compares much faster than
+# (seqid, start, ID) tuples.
+# Args:
+#  f (Feature) usually the root of a model
+#  order (dict) chromosome order table. Unknown seqids are appended to it.
+#
+def sortKey(f, order=CHR_ORDER):
+    rank = order.get(f[0], None)
+    if rank is None:
+        rank = order[f[0]] = len(order)
+    start = f[3]
+    return (rank << 32) | (0 if start == "." else start)
+
 #----------------------------------------------------
 # Merges n sorted input feature streams into one 
 # Args:
 #  featureIterators list of iterators over features.
+#  key (function, optional) computes the sort key of an item. Default is
+#       sortKey, using the chrOrder table (if given) or the default CHR_ORDER.
+#  chrOrder (dict, optional) chromosome order table (see chrOrder())
 # Returns:
 #  iterator over the merged stream
-def merge(*featureIters):
-    mis = [ map(lambda m:(m.seqid, m.start, m.ID, m), i) for i in featureIters ]
-    for m in heapq.merge(*mis):
-        yield m[3]
+# Each item's key is computed exactly once. Items with equal keys come out in 
+# the order of their input streams (so, stable w.r.t. the argument order).
+#
+def merge(*featureIters, key=None, chrOrder=None):
+    if key is None:
+        order = CHR_ORDER if chrOrder is None else chrOrder
+        key = lambda f: sortKey(f, order)
+    heap = []
+    for i, it in enumerate(featureIters):
+        it = iter(it)
+        for f in it:
+            heap.append((key(f), i, f, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        k, i, f, it = heap[0]
+        yield f
+        for f in it:
+            heapq.heapreplace(heap, (key(f), i, f, it))
+            break
+        else:
+            heapq.heappop(heap)
 
 #----------------------------------------------------
 #
@@ -485,36 +658,116 @@ class IdMaker:
         i = self.ids[prefix] = self.ids.setdefault(prefix,0) + 1
         return prefix + str(i)
 
+#----------------------------------------------------
+# 
+# Output sinks for gff3 text, models, and features.
+# A ModelSink writes everything to one stream. A ChrSink routes each line (or model)
+# to a file per chromosome, named by fileTemplate % chromosome.
+#
+#       sink = gff3.ChrSink("ncbi.chr%s.gff")
+#       for m in models:
+#           sink.writeModel(gff3.flattenModel(m))
+#       sink.close()
+#
+class ModelSink:
+    def __init__(self, fd):
+        self.fd = fd
+
+    # Writes one or more whole lines (all for the same chromosome).
+    def write(self, s):
+        self.fd.write(s)
+
+    # Writes a model, given as a list of features (root first).
+    def writeModel(self, feats):
+        self.write("".join([format(f) for f in feats]))
+
+    def close(self):
+        pass
+
+# Routes to a file per chromosome (column 1). Output is buffered per chromosome (up to
+# bufSize characters). To allow for the many unlocalized contigs in some providers' files,
+# at most maxOpen files are kept open; the least recently written one is closed when another
+# is needed, and reopened (for append) if written again.
+#
+class ChrSink(ModelSink):
+    def __init__(self, fileTemplate, bufSize=256*1024, maxOpen=64):
+        self.fileTemplate = fileTemplate
+        self.bufSize = bufSize
+        self.maxOpen = maxOpen
+        self.buffers = {}       # chromosome -> [ list of strings, total length ]
+        self.fds = {}           # chromosome -> open file, least recently used first
+        self.chrs = []          # chromosomes written, in order of first appearance
+        self.last = None        # last chromosome written
+        self.opened = set()     # chromosomes whose files have been created
+
+    def write(self, s):
+        c = s[:s.find(TAB)] if s != GROUPSEP else self.last
+        self.append(c, s)
+
+    def writeModel(self, feats):
+        self.append(feats[0][0], "".join([format(f) for f in feats]))
+
+    # Adds s to the buffer for chromosome c.
+    def append(self, c, s):
+        b = self.buffers.get(c, None)
+        if b is None:
+            b = self.buffers[c] = [[], 0]
+            self.chrs.append(c)
+        b[0].append(s)
+        b[1] += len(s)
+        self.last = c
+        if b[1] >= self.bufSize:
+            self.flush(c)
+
+    # Writes out the buffer for chromosome c.
+    def flush(self, c):
+        b = self.buffers[c]
+        if b[1] == 0:
+            return
+        fd = self.fds.pop(c, None)
+        if fd is None:
+            if len(self.fds) >= self.maxOpen:
+                oldest = next(iter(self.fds))
+                self.fds.pop(oldest).close()
+            # first open truncates, later ones append
+            fd = open(self.fileTemplate % c, 'a' if c in self.opened else 'w')
+            self.opened.add(c)
+        self.fds[c] = fd
+        fd.write("".join(b[0]))
+        b[0] = []
+        b[1] = 0
+
+    def close(self):
+        for c in self.chrs:
+            self.flush(c)
+        for fd in self.fds.values():
+            fd.close()
+        self.fds = {}
+
 #----------------------------------------------------
 # 
 # splitFile
 # 
-# Splits a gff3 file into separate files based on chromosome.
+# Splits a gff3 file into separate files based on chromosome. Lines are routed as is
+# (without being parsed). Group separators go with the preceding line.
 # Args:
-#   features    
+#   features    file name, open file, or lines
 #   directory
 #   fileTemplate
 # Returns:
 #   nothing
 #
 def splitFile(features, directory, fileTemplate):
-    c2file = {}
-    lastFd = None
-    for f in iterate(features, returnSeparators=True):
-        if f == GROUPSEP:
-            lastFd.write(GROUPSEP)
-            continue
-        c = f.seqid
-        fd = c2file.get(c, None)
-        if not fd:
-            fileName = os.path.join(directory, fileTemplate % c)
-            fd = open(fileName, 'w')
-            c2file[c] = fd
-        fd.write(str(f))
-        lastFd = fd
-
-    for (c,fd) in list(c2file.items()):
-        fd.close()
+    if type(features) is str:
+        features = sys.stdin if features == "-" else open(features, 'r')
+    sink = ChrSink(os.path.join(directory, fileTemplate))
+    for line in features:
+        if line == GROUPSEP:
+            if sink.last is not None:
+                sink.write(line)
+        elif not line.startswith(COMMENT_CHAR) and line.strip():
+            sink.write(line)
+    sink.close()
 
 #----------------------------------------------------
 # Builds and returns an index from feature.ID to feature.
@@ -9,12 +9,52 @@
 # (2) Set module global variables: HOST, DATABASE, USER,  PASSWORD.
 # (3) Create a connection and pass it to the sql() call.
 #
+# For large results, iterate() and copy() stream the rows as tuples, rather than returning
+# a list of dicts:
+#   iterate(query) reads from a named (server-side) cursor, batchSize rows per round trip.
+#   copy(query) runs COPY (query) TO STDOUT, and parses the rows from the text stream.
+#       All values are strings (or None for NULL).
+# Either way, only a batch of rows is held in memory at a time.
+#
+#   for (mgiid, symbol) in iterate('select accid, symbol from ...'):
+#       ...
+#
+# Calls without a connection borrow one from a pool (of up to POOLSIZE connections, opened as
+# needed and kept until exit), rather than opening and closing their own.
+# Independent queries can be run at the same time, each on its own pooled connection, in a
+# thread: submit() returns a Future, sqlConcurrent() waits for all. A query can also be given
+# as a function of a connection (e.g. one that calls iterate or copy and builds a dict).
+#
+#   genes, seqs = sqlConcurrent([q1, q2])
+#   f = submit(lambda con: dict(copy(q3, con)))
+#   ... (do other work) ...
+#   d = f.result()
+#
+# Select results can be cached on disk (opt-in: set MGI_QUERY_CACHE to a directory). Each
+# result is stored in its own file, keyed by the query text (and how it was run: sql, iterate,
+# or copy) and a freshness token: the result of FRESHNESS_QUERY (by default, the date of the
+# last database dump), run once per process. So a cached result is used until the database is
+# refreshed, or it is older than MGI_QUERY_CACHE_TTL seconds. The files are a series of pickled
+# batches of row tuples, written as the rows are first read (and kept only if all are read).
+# clearCache() (or: python mgiadhoc.py clearcache) removes cached results.
+#
 import os
 import sys
+import re
+import time
+import pickle
+import hashlib
 import types
+import atexit
+import threading
+import itertools
+import contextlib
+import concurrent.futures
 
 import psycopg2
+import psycopg2.pool
 import psycopg2.extras
+import psycopg2.extensions
 
 # Default connection parameters
 HOST     = os.environ.get("MGI_HOST")
@@ -22,11 +62,77 @@ DATABASE = os.environ.get("MGI_DATABASE")
 USER     = os.environ.get("MGI_USER",     "mgd_public")
 PASSWORD = os.environ.get("MGI_PASSWORD", "mgdpub")
 
+# Rows fetched per round trip by iterate().
+BATCHSIZE = 10000
+
+# Max number of pooled connections (and of queries run at the same time by submit).
+POOLSIZE = int(os.environ.get("MGI_POOLSIZE") or 4)
+
+# Query result cache (see above). Empty CACHEDIR = no caching.
+CACHEDIR = os.environ.get("MGI_QUERY_CACHE", "")
+CACHETTL = float(os.environ.get("MGI_QUERY_CACHE_TTL") or 7 * 24 * 3600)
+FRESHNESS_QUERY = os.environ.get("MGI_FRESHNESS_QUERY", "select lastdump_date from mgi_dbinfo")
+
 #
 def connect(host=HOST,database=DATABASE, user=USER, password=PASSWORD):
     con = psycopg2.connect( host=host, database=database, user=user, password=password )
     return con
 
+#----------------------------------------------------
+# Connection pool. Created on first use, with the connection parameters at that time.
+#
+_pool = None
+_poolSlots = None
+_executor = None
+_lock = threading.Lock()
+
+def getPool():
+    global _pool, _poolSlots
+    with _lock:
+        if _pool is None:
+            if POOLSIZE < 1:
+                raise ValueError("MGI_POOLSIZE must be at least 1 (got %d)" % POOLSIZE)
+            _pool = psycopg2.pool.ThreadedConnectionPool(0, POOLSIZE,
+                host=HOST, database=DATABASE, user=USER, password=PASSWORD)
+            # getconn fails (rather than waits) when all connections are out
+            _poolSlots = threading.BoundedSemaphore(POOLSIZE)
+            atexit.register(closePool)
+    return _pool
+
+# Closes all pooled connections.
+def closePool():
+    global _pool, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+# Borrows a connection from the pool, for the duration of a with block. The connection's
+# transaction is rolled back when it is returned. If the block raises (or is a generator
+# that is closed early), the connection is discarded instead, since it may be mid-query.
+#
+@contextlib.contextmanager
+def pooledConnection():
+    pool = getPool()
+    _poolSlots.acquire()
+    con = None
+    ok = False
+    try:
+        con = pool.getconn()
+        yield con
+        ok = True
+    finally:
+        if con is not None:
+            if ok and not con.closed:
+                con.rollback()
+                pool.putconn(con)
+            else:
+                pool.putconn(con, close=True)
+        _poolSlots.release()
+
 #
 def sql(queries, parsers=None, connection=None):
     single = False
@@ -39,16 +145,27 @@ def sql(queries, parsers=None, connection=None):
     if len(queries) != len(parsers):
         raise RuntimeError("Number of queries != number of parsers.")
 
-    closeCon = False
     if connection is None:
-        connection = connect()
-        closeCon = True
+        with pooledConnection() as con:
+            results = sql(queries, parsers, con)
+        return results[0] if single else results
 
     results = []
     for i,q in enumerate(queries):
+        p = parsers[i]
+        if p != 'ignore' and isSelect(q):
+            # (possibly cached) rows; the first item is the column names
+            rows = cachedRows("sql", q, connection, lambda q=q: _selectRows(q, connection))
+            names = next(rows)
+            if p is None:
+                results.append([dict(zip(names, r)) for r in rows])
+            else:
+                for r in rows:
+                    p( dict(zip(names, r)) )
+                results.append(None)
+            continue
         cur = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         cur.execute(q)
-        p = parsers[i]
         if p == 'ignore':
             results.append(None)
         elif cur.statusmessage.startswith('SELECT'):
@@ -65,14 +182,256 @@ def sql(queries, parsers=None, connection=None):
             results.append(None)
         cur.close()
 
-    if closeCon:
-        connection.close()
-
     if single:
         return results[0]
     else:
         return results
 
+# Yields the column names (a tuple), then the rows (tuples) of a select query.
+def _selectRows(query, connection):
+    cur = connection.cursor()
+    try:
+        cur.execute(query)
+        yield tuple([d[0] for d in cur.description])
+        yield from cur
+    finally:
+        cur.close()
+
+#----------------------------------------------------
+# Yields the rows (tuples) of a select query, from a named (server-side) cursor,
+# fetching batchSize rows at a time. If asDicts is True, yields dicts instead.
+#
+_cursorCount = itertools.count()
+
+def iterate(query, connection=None, batchSize=BATCHSIZE, asDicts=False):
+    rows = cachedRows("iterate", query, connection, lambda: _iterateRows(query, connection, batchSize))
+    names = next(rows)
+    if asDicts:
+        for r in rows:
+            yield dict(zip(names, r))
+    else:
+        yield from rows
+
+# Yields the column names (a tuple), then the rows, from a named cursor.
+def _iterateRows(query, connection, batchSize):
+    if connection is None:
+        with pooledConnection() as con:
+            yield from _iterateRows(query, con, batchSize)
+        return
+    cur = connection.cursor(name="mgiadhoc_%d_%d" % (os.getpid(), next(_cursorCount)))
+    try:
+        cur.itersize = batchSize
+        cur.execute(query)
+        first = True
+        while True:
+            rows = cur.fetchmany(batchSize)
+            if first:
+                yield tuple([d[0] for d in cur.description])
+                first = False
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+#----------------------------------------------------
+# Yields the rows (tuples of strings, None for NULL) of a query, using COPY (query) TO STDOUT.
+# The COPY data is written (by psycopg2, in a thread) to a pipe, and parsed as it arrives.
+#
+COPY_ESCAPES = { 'b':'\b', 'f':'\f', 'n':'\n', 'r':'\r', 't':'\t', 'v':'\v' }
+COPY_ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+COPY_NULL = '\\N'
+
+def _unescape(m):
+    e = m.group(1)
+    if e[0] == 'x':
+        return chr(int(e[1:], 16))
+    elif e[0].isdigit():
+        return chr(int(e, 8))
+    return COPY_ESCAPES.get(e, e)
+
+# Parses one line of COPY text format into a tuple of values.
+def parseCopyLine(line):
+    if line[-1:] == '\n':
+        line = line[:-1]
+    fields = line.split('\t')
+    if '\\' not in line:
+        return tuple(fields)
+    return tuple([None if f == COPY_NULL else (COPY_ESCAPE_RE.sub(_unescape, f) if '\\' in f else f) for f in fields])
+
+def copy(query, connection=None, bufSize=1024*1024):
+    return cachedRows("copy", query, connection, lambda: _copyRows(query, connection, bufSize))
+
+def _copyRows(query, connection, bufSize):
+    if connection is None:
+        with pooledConnection() as con:
+            yield from _copyRows(query, con, bufSize)
+        return
+    encoding = psycopg2.extensions.encodings.get(connection.encoding, 'utf8')
+    rfd, wfd = os.pipe()
+    rd = os.fdopen(rfd, 'rb', bufSize)
+    wr = os.fdopen(wfd, 'wb', bufSize)
+    errors = []
+    def writer():
+        try:
+            cur = connection.cursor()
+            cur.copy_expert("COPY (%s) TO STDOUT" % query.strip().rstrip(';'), wr, size=bufSize)
+            cur.close()
+        except BrokenPipeError:
+            # the reader stopped early
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                wr.close()
+            except BrokenPipeError:
+                pass
+    t = threading.Thread(target=writer, daemon=True)
+    t.start()
+    try:
+        for line in rd:
+            yield parseCopyLine(line.decode(encoding))
+    finally:
+        rd.close()
+        t.join()
+    if errors:
+        raise errors[0]
+
+#----------------------------------------------------
+# Query result cache (see above).
+#
+SELECT_RE = re.compile(r'^\s*select\b', re.IGNORECASE)
+CACHESUFFIX = ".qc"
+_freshness = None
+
+# Only select queries are cached.
+def isSelect(query):
+    return SELECT_RE.match(query) is not None
+
+# Returns the freshness token (a string), or None if FRESHNESS_QUERY fails.
+def freshnessToken(connection=None):
+    global _freshness
+    if _freshness is None:
+        try:
+            if connection is None:
+                with pooledConnection() as con:
+                    return freshnessToken(con)
+            cur = connection.cursor()
+            cur.execute(FRESHNESS_QUERY)
+            _freshness = repr(cur.fetchall())
+            cur.close()
+        except Exception as e:
+            sys.stderr.write("Query cache disabled: freshness query failed (%s)\n" % e)
+            _freshness = False
+    return _freshness or None
+
+# Returns the cache file for a query, or None if it is not to be cached.
+def cacheFile(kind, query, connection=None):
+    if not CACHEDIR or not isSelect(query):
+        return None
+    token = freshnessToken(connection)
+    if token is None:
+        return None
+    key = hashlib.sha1("\0".join([kind, query, token]).encode()).hexdigest()
+    return os.path.join(CACHEDIR, key + CACHESUFFIX)
+
+# Yields the rows stored in a cache file.
+def _readCache(fname, fd):
+    with fd:
+        pickle.load(fd)
+        while True:
+            try:
+                batch = pickle.load(fd)
+            except EOFError:
+                break
+            yield from batch
+
+# Returns an iterator over the rows of query, from the cache if there, otherwise from
+# rowsFcn() (which is called to run the query). In the latter case, the rows are also
+# written to the cache as they go by.
+#
+def cachedRows(kind, query, connection, rowsFcn):
+    fname = cacheFile(kind, query, connection)
+    if fname is None:
+        return rowsFcn()
+    try:
+        if time.time() - os.path.getmtime(fname) < CACHETTL:
+            return _readCache(fname, open(fname, 'rb'))
+        os.remove(fname)
+    except OSError:
+        pass
+    return _writeCache(fname, kind, query, rowsFcn())
+
+def _writeCache(fname, kind, query, rows):
+    os.makedirs(CACHEDIR, exist_ok=True)
+    tmp = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+    ok = False
+    try:
+        with open(tmp, 'wb') as fd:
+            pickle.dump({ "kind" : kind, "query" : query, "token" : _freshness, "time" : time.time() }, fd)
+            batch = []
+            for r in rows:
+                batch.append(tuple(r))
+                if len(batch) >= BATCHSIZE:
+                    pickle.dump(batch, fd, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+                yield r
+            pickle.dump(batch, fd, pickle.HIGHEST_PROTOCOL)
+        ok = True
+    finally:
+        if ok:
+            os.replace(tmp, fname)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+# Removes cached results: all of them, or those for query (however it was run).
+def clearCache(query=None):
+    if not CACHEDIR or not os.path.isdir(CACHEDIR):
+        return 0
+    n = 0
+    for f in os.listdir(CACHEDIR):
+        fname = os.path.join(CACHEDIR, f)
+        if not f.endswith(CACHESUFFIX):
+            continue
+        if query is not None:
+            try:
+                with open(fname, 'rb') as fd:
+                    if pickle.load(fd)["query"] != query:
+                        continue
+            except Exception:
+                pass
+        os.remove(fname)
+        n += 1
+    return n
+
+#----------------------------------------------------
+# Runs a query in a thread, on its own pooled connection. Returns a concurrent.futures.Future,
+# whose result is what sql(query, parser) returns. Or, if query is a function, it is called
+# with the connection, and the result is what it returns.
+#
+def submit(query, parser=None):
+    global _executor
+    getPool()
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(POOLSIZE, thread_name_prefix="mgiadhoc")
+    def run():
+        with pooledConnection() as con:
+            if callable(query):
+                return query(con)
+            return sql(query, parser, con)
+    return _executor.submit(run)
+
+# Runs independent queries at the same time (see submit). Returns their results, in order.
+def sqlConcurrent(queries, parsers=None):
+    if type(parsers) not in [list,tuple]:
+        parsers = [parsers]*len(queries)
+    if len(queries) != len(parsers):
+        raise RuntimeError("Number of queries != number of parsers.")
+    futures = [submit(q, p) for q, p in zip(queries, parsers)]
+    return [f.result() for f in futures]
+
 #
 def __test__():
     def p(r):
@@ -85,5 +444,8 @@ def __test__():
     sql( qlist, ['ignore', p])
 
 if __name__ == "__main__":
-    __test__()
+    if sys.argv[1:] == ["clearcache"]:
+        print("Removed %d cached results." % clearCache())
+    else:
+        __test__()
 
@@ -0,0 +1,158 @@
+#
+# mgiindex.py
+#
+# Index of the MGI genes (the file written by mgiPrep.py), by chromosome and by Dbxref.
+# This is what merge.py uses to find the MGI gene(s) for each provider model.
+#
+# The index can be built in memory from mgi.gff, or written to (and lazily read from)
+# an index file, so that a merge of one chromosome only loads that chromosome's genes,
+# rather than parsing the entire genome-wide mgi.gff.
+#
+# Index file layout:
+#       8 bytes         length, N, of the header
+#       N bytes         header: pickled dict { chromosome -> (offset, length) }
+#       ...             one block per chromosome: a zlib compressed, pickled tuple (lines, xrefs), where
+#                       lines is the chromosome's gff3 lines, in file order, and xrefs
+#                       is a dict { Dbxref -> [ index into lines ] }.
+#       Offsets are relative to the end of the header.
+#
+# Usage:
+#       Build an index file:
+#       $ python mgiindex.py mgi.gff mgi.idx
+#
+#       In code:
+#       idx = mgiindex.load("mgi.idx")     # or mgi.gff
+#       for g in idx.lookup("14", "NCBI_Gene:12345"):
+#           ...
+#
+
+import sys
+import struct
+import pickle
+import zlib
+import gff3
+
+HEADERLEN = struct.Struct('>Q')
+
+#----------------------------------------------------
+# The index proper. Maps chromosome -> list of MGI gene features on that chromosome,
+# and chromosome -> { Dbxref -> list of features }.
+#
+class MgiIndex:
+    def __init__(self):
+        self.chr2genes = {}
+        self.chr2xrefs = {}
+
+    # Adds one MGI gene feature.
+    def add(self, f):
+        c = f.seqid
+        genes = self.chr2genes.setdefault(c, [])
+        xrefs = self.chr2xrefs.setdefault(c, {})
+        genes.append(f)
+        for xref in f.attributes.get('Dbxref', []):
+            xrefs.setdefault(xref, []).append(f)
+
+    # Hook for subclasses that load chromosomes on demand.
+    def loadChr(self, c):
+        pass
+
+    # Returns the chromosomes in the index.
+    def chromosomes(self):
+        return list(self.chr2genes.keys())
+
+    # Returns the MGI genes on chromosome c.
+    def genes(self, c):
+        self.loadChr(c)
+        return self.chr2genes.get(c, [])
+
+    # Returns the MGI genes on chromosome c that have the given Dbxref.
+    def lookup(self, c, xref):
+        self.loadChr(c)
+        return self.chr2xrefs.get(c, {}).get(xref, [])
+
+#----------------------------------------------------
+# An MgiIndex backed by an index file. A chromosome's block is read and
+# its features created the first time the chromosome is asked for.
+#
+class MgiIndexFile(MgiIndex):
+    def __init__(self, fileName):
+        MgiIndex.__init__(self)
+        self.fileName = fileName
+        with open(fileName, 'rb') as fd:
+            n = HEADERLEN.unpack(fd.read(HEADERLEN.size))[0]
+            self.header = pickle.loads(fd.read(n))
+        self.dataStart = HEADERLEN.size + n
+
+    def chromosomes(self):
+        return list(self.header.keys())
+
+    def loadChr(self, c):
+        if c in self.chr2genes:
+            return
+        genes = self.chr2genes[c] = []
+        xrefs = self.chr2xrefs[c] = {}
+        if c not in self.header:
+            return
+        offset, length = self.header[c]
+        with open(self.fileName, 'rb') as fd:
+            fd.seek(self.dataStart + offset)
+            lines, xrefIxs = pickle.loads(zlib.decompress(fd.read(length)))
+        genes.extend([gff3.Feature(line) for line in lines])
+        for xref, ixs in xrefIxs.items():
+            xrefs[xref] = [genes[i] for i in ixs]
+
+    # Loads all chromosomes.
+    def loadAll(self):
+        for c in self.header:
+            self.loadChr(c)
+
+#----------------------------------------------------
+# Builds an in-memory MgiIndex from a gff3 file of MGI genes.
+# Dbxrefs associated with more than one gene are reported via log.
+#
+def build(mgiFile, log=None):
+    idx = MgiIndex()
+    seen = set()
+    for f in gff3.iterate(mgiFile):
+        for xref in f.attributes.get('Dbxref', []):
+            if xref in seen:
+                if log: log("WARNING: ID %s associated with multiple genes.\n" % xref)
+            else:
+                seen.add(xref)
+        idx.add(f)
+    return idx
+
+#----------------------------------------------------
+# Writes an MgiIndex to an index file.
+#
+def write(idx, fileName):
+    header = {}
+    blocks = []
+    offset = 0
+    for c in idx.chromosomes():
+        genes = idx.genes(c)
+        pos = dict([(id(f), i) for (i, f) in enumerate(genes)])
+        xrefs = dict([(x, [pos[id(f)] for f in fs]) for (x, fs) in idx.chr2xrefs[c].items()])
+        block = zlib.compress(pickle.dumps(([str(f) for f in genes], xrefs), pickle.HIGHEST_PROTOCOL))
+        header[c] = (offset, len(block))
+        blocks.append(block)
+        offset += len(block)
+    hdr = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+    with open(fileName, 'wb') as fd:
+        fd.write(HEADERLEN.pack(len(hdr)))
+        fd.write(hdr)
+        for block in blocks:
+            fd.write(block)
+
+#----------------------------------------------------
+# Returns an MgiIndex for the given file, which is either an index file
+# (name ends with ".idx") or a gff3 file of MGI genes.
+#
+def load(fileName, log=None):
+    if fileName.endswith(".idx"):
+        return MgiIndexFile(fileName)
+    return build(fileName, log)
+
+#----------------------------------------------------
+if __name__ == "__main__":
+    write(build(sys.argv[1], sys.stderr.write), sys.argv[2])
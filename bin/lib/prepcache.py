@@ -0,0 +1,198 @@
+#
+# prepcache.py
+#
+# A cache of prepped provider outputs (the chromosome files, e.g. ncbi.chr6.gff, and the
+# header files written by refresh), so that an unchanged provider release is not downloaded
+# and prepped again.
+#
+# Entries are keyed by provider, release version, and a hash of the prep code (prepAll.py, the
+# provider's prep script, gff3.py, transform.py) and the url. Each entry is a directory,
+# CACHEDIR/KEY, holding copies of the files and a manifest (JSON: files, url, and the file's
+# size/ETag/Last-Modified when it was stored). An entry is used only if, in addition, the server
+# does not report the file as modified since (see download.notModified; skipped for ftp urls,
+# or if the server gives no validators).
+# Without a version (key PROVIDER.current.HASH) and without validators, there is no way to tell
+# that the file has changed (e.g. a new miRBase CURRENT release), so such entries are not stored
+# (or used).
+# Entries are evicted least recently used first (by the manifest's mtime, which is touched
+# each time an entry is used) to keep the total size under MAXSIZE.
+#
+# Usage:
+#       $ python prepcache.py key PROVIDER VERSION URL
+#               Prints the key.
+#       $ python prepcache.py -d CACHEDIR get KEY URL DIR
+#               Copies the entry's files into DIR. Exits with status 1 if there is no (usable) entry.
+#       $ python prepcache.py -d CACHEDIR [-m MAXSIZE] put KEY URL FILE ...
+#               Stores the files as entry KEY, then evicts old entries. MAXSIZE is bytes, or
+#               with a K, M, or G suffix.
+#
+
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import download
+
+BINDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST = "manifest.json"
+MAXSIZE = "20G"
+
+# The code each provider's prepped output depends on (relative to bin).
+COMMON_SCRIPTS = [ "prepAll.py", "lib/gff3.py", "lib/transform.py" ]
+PREP_SCRIPTS = {
+    "ncbi"    : [ "ncbiPrep.py" ],
+    "ensembl" : [ "ensemblPrep.py" ],
+    "mirbase" : [ "mirbasePrep.py" ],
+}
+
+#----------------------------------------------------
+# Returns the cache key for a provider's prepped output: PROVIDER.VERSION.HASH
+#
+def makeKey(provider, version, url):
+    h = hashlib.sha1(url.encode())
+    for s in COMMON_SCRIPTS + PREP_SCRIPTS.get(provider, []):
+        with open(os.path.join(BINDIR, s), 'rb') as fd:
+            h.update(fd.read())
+    version = re.sub(r'[^A-Za-z0-9_.-]', '_', version) or "current"
+    return "%s.%s.%s" % (provider, version, h.hexdigest()[:16])
+
+# Returns the version part of a key ("current" if none was given).
+def keyVersion(key):
+    return key.split(".", 1)[1].rsplit(".", 1)[0]
+
+# Returns True if an entry for key, with file metadata meta (see download.probeMeta), can tell
+# when it is stale: the key has a version, or the server gives validators for the file.
+def checkable(key, meta):
+    return keyVersion(key) != "current" or bool(meta.get("etag") or meta.get("lastModified"))
+
+# Parses a size, e.g. "500M"
+def parseSize(s):
+    m = re.match(r'^(\d+)([KMG]?)$', s.strip().upper())
+    if not m:
+        raise ValueError("Bad size: " + s)
+    return int(m.group(1)) * { "" : 1, "K" : 2**10, "M" : 2**20, "G" : 2**30 }[m.group(2)]
+
+#----------------------------------------------------
+class PrepCache:
+    def __init__(self, cacheDir, maxSize=MAXSIZE):
+        self.dir = cacheDir
+        self.maxSize = parseSize(maxSize) if type(maxSize) is str else maxSize
+        os.makedirs(self.dir, exist_ok=True)
+
+    def log(self, s):
+        sys.stderr.write(s)
+
+    # Returns the manifest of entry key, or None.
+    def manifest(self, key):
+        try:
+            with open(os.path.join(self.dir, key, MANIFEST)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    # Copies the files of entry key into dir. Returns the list of files copied, or None
+    # if there is no entry, or the file at url has changed since the entry was stored.
+    def get(self, key, url, dir):
+        m = self.manifest(key)
+        if m is None:
+            self.log("Prep cache miss: %s\n" % key)
+            return None
+        if not checkable(key, m["meta"]):
+            self.log("Prep cache entry %s not used (no version, and no validators for %s).\n" % (key, url))
+            return None
+        if (m["meta"].get("etag") or m["meta"].get("lastModified")) and not download.notModified(url, m["meta"]):
+            self.log("Prep cache entry %s is stale (%s has changed).\n" % (key, url))
+            return None
+        edir = os.path.join(self.dir, key)
+        for f in m["files"]:
+            shutil.copyfile(os.path.join(edir, f), os.path.join(dir, f))
+        os.utime(os.path.join(edir, MANIFEST))
+        self.log("Prep cache hit: %s (%d files)\n" % (key, len(m["files"])))
+        return m["files"]
+
+    # Stores files as entry key (replacing any existing entry), then evicts old entries.
+    def put(self, key, url, files):
+        try:
+            meta = download.probeMeta(url)
+        except Exception as e:
+            self.log("Could not probe %s (%s).\n" % (url, e))
+            meta = { "url" : url }
+        if not checkable(key, meta):
+            self.log("Prep cache: not storing %s (no version, and no validators for %s).\n" % (key, url))
+            return
+        tmp = os.path.join(self.dir, ".%s.%d" % (key, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        names = []
+        for f in files:
+            n = os.path.basename(f)
+            shutil.copyfile(f, os.path.join(tmp, n))
+            names.append(n)
+        with open(os.path.join(tmp, MANIFEST), 'w') as fd:
+            json.dump({ "key" : key, "url" : url, "meta" : meta, "files" : names, "stored" : time.time() }, fd)
+        edir = os.path.join(self.dir, key)
+        shutil.rmtree(edir, ignore_errors=True)
+        os.rename(tmp, edir)
+        self.log("Prep cache stored: %s (%d files)\n" % (key, len(names)))
+        self.evict(keep=key)
+
+    # Returns a list of (last used, size, key) for the entries in the cache.
+    def entries(self):
+        es = []
+        for key in os.listdir(self.dir):
+            edir = os.path.join(self.dir, key)
+            mfile = os.path.join(edir, MANIFEST)
+            if key.startswith(".") or not os.path.exists(mfile):
+                continue
+            size = sum([os.path.getsize(os.path.join(edir, f)) for f in os.listdir(edir)])
+            es.append((os.path.getmtime(mfile), size, key))
+        return es
+
+    # Removes least recently used entries (other than keep) until the total size is at most maxSize.
+    def evict(self, keep=None):
+        es = self.entries()
+        es.sort()
+        total = sum([e[1] for e in es])
+        for used, size, key in es:
+            if total <= self.maxSize:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.dir, key), ignore_errors=True)
+            total -= size
+            self.log("Prep cache evicted: %s (%d bytes)\n" % (key, size))
+
+#----------------------------------------------------
+def getArgs():
+    parser = argparse.ArgumentParser(description='Cache of prepped provider files.')
+    parser.add_argument('-d', '--dir', default=None, help='cache directory')
+    parser.add_argument('-m', '--maxsize', default=MAXSIZE, help='max total size of the cache (default %s)' % MAXSIZE)
+    parser.add_argument('command', choices=['key', 'get', 'put'])
+    parser.add_argument('args', nargs='+')
+    args = parser.parse_args()
+    if args.command != 'key' and not args.dir:
+        parser.error("a cache directory (-d) is required")
+    return args
+
+def main():
+    args = getArgs()
+    if args.command == 'key':
+        provider, version, url = args.args
+        print(makeKey(provider, version, url))
+        return
+    pc = PrepCache(args.dir, args.maxsize)
+    if args.command == 'get':
+        key, url, dir = args.args
+        if pc.get(key, url, dir) is None:
+            sys.exit(1)
+    else:
+        key, url = args.args[:2]
+        pc.put(key, url, args.args[2:])
+
+#
+if __name__ == "__main__":
+    main()
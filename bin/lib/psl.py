@@ -11,6 +11,13 @@
 #       fields (blockSizes, qStarts, tStarts) are represented as lists of integers.
 #
 #    iterate(): for iterating through a psl file. Each iteration returns next Alignment object.
+#
+#    class Table: a whole psl file, by column. Numeric fields are arrays, the string fields are
+#       lists, and the three multivalued fields are each one flat array of all the alignments'
+#       values, cut up by blockOffsets (alignment i's blocks are at blockOffsets[i]:blockOffsets[i+1]).
+#       Derived values (matchLength, percentLength, ...) are computed a column at a time.
+#
+#    toGff(): converts alignments to gff3 match/match_part features.
 # 
 # PSL FORMAT:
 # Psl is the format output by the Blat sequence alignment tool.
@@ -47,6 +54,7 @@
 #
 
 import sys
+from array import array
 import gff3
 
 TAB     = '\t'
@@ -178,59 +186,140 @@ def iterate(input):
     if closeit:
         input.close()
 
+class Table:
+
+    strFields = (8, 9, 13)
+    blockFields = (18, 19, 20)
+
+    # input is a file name, "-" for stdin, or an open file.
+    def __init__(self, input):
+        closeit = False
+        if type(input) is str:
+            if input=="-":
+                input = sys.stdin
+            else:
+                input = open(input, 'r')
+                closeit = True
+        rows = [ line.rstrip(NL).split(TAB) for line in input if line.strip() ]
+        if closeit:
+            input.close()
+        for r in rows:
+            if len(r) != len(Alignment.fields):
+                raise ValueError("Invalid psl line: %d fields\n%s" % (len(r), TAB.join(r)))
+        columns = list(zip(*rows)) if rows else [ () ] * len(Alignment.fields)
+        for (i,name) in enumerate(Alignment.fields):
+            if i in Table.strFields:
+                self.__dict__[name] = list(columns[i])
+            elif i in Table.blockFields:
+                values = array('l')
+                for v in columns[i]:
+                    values.extend(map(int, v.strip().rstrip(COMMA).split(COMMA)))
+                self.__dict__[name] = values
+            else:
+                self.__dict__[name] = array('l', map(int, columns[i]))
+        self.blockOffsets = array('l', [0])
+        for n in self.blockCount:
+            self.blockOffsets.append(self.blockOffsets[-1] + n)
+        if self.blockOffsets[-1] != len(self.blockSizes):
+            raise ValueError("psl blockCount does not agree with blockSizes")
+
+    def __len__(self):
+        return len(self.qName)
+
+    # Returns alignment i's values of a multivalued field (e.g. self.blocks(self.tStarts, i)).
+    def blocks(self, column, i):
+        return column[self.blockOffsets[i]:self.blockOffsets[i+1]]
+
+    # Returns alignment i as an Alignment.
+    def row(self, i):
+        a = [ self.__dict__[name][i] for name in Alignment.fields[:18] ]
+        a += [ list(self.blocks(self.__dict__[name], i)) for name in Alignment.fields[18:] ]
+        return Alignment(a)
+
+    # The derived columns. Same values as the Alignment methods of the same names.
+    def score (self):
+        return [ m - mm - qi - ti for (m, mm, qi, ti) in zip(self.matches, self.misMatches, self.qNumInsert, self.tNumInsert) ]
+
+    def matchLength(self):
+        o = self.blockOffsets
+        bs = self.blockSizes
+        return [ sum(bs[o[i]:o[i+1]]) for i in range(len(self)) ]
+
+    def percentIdentity(self):
+        return [ (100.0 * m) / l for (m, l) in zip(self.matches, self.matchLength()) ]
+
+    def percentLength(self):
+        return [ (100.0 * l) / s for (l, s) in zip(self.matchLength(), self.qSize) ]
+
+    # Returns the gff3 model (root match feature, with its match_parts as children) for
+    # alignment i. IDs are the same as toGff assigns reading the whole file.
+    def toGff(self, i):
+        aid = "match%d" % (i + 1)
+        pids = [ "match_part%d" % (j + 1) for j in range(self.blockOffsets[i], self.blockOffsets[i+1]) ]
+        feats = alignmentToGff(self.row(i), aid, pids)
+        gff3.crossReference(feats)
+        return feats[0]
+
 def toGff(input):
-    # for notes on converting between psl and gff coordinates see: http://genome.ucsc.edu/FAQ/FAQformat.html#format2
     alignments = iterate(input)
     idMaker = gff3.IdMaker()
     for a in alignments:
-        # mint an id of the form "matchN"
+        # mint ids of the form "matchN" and "match_partN"
         aid = idMaker.next("match")
-        (gs,ge) = psl2gff(a.tSize, a.tStart, a.tEnd, "+") # the alignment coords are always w.r.t + strand
-        root = gff3.Feature([
-                a.tName,
-                "BlatAlignment",
-                "match",
-                gs,
-                ge,
-                ".",
-                a.strand,
-                '.',
-                {
-                    'ID'    : aid,
-                    'Name'  : a.qName,
-                    'qName' : a.qName,
-                    'matchLen' : a.matchLength(),
-                    'pctIdentity' : a.percentIdentity(),
-                    'pctLength' : a.percentLength(),
-                    'score' : a.score(),
-                    'qStart' : a.qStart,
-                    'qEnd' : a.qEnd,
-                    'qSize' : a.qSize,
-                    'matches' : a.matches,
-                }
-               ])
-        yield root 
-        for i,tstart in enumerate(a.tStarts):
-            # alignment seg coordinates are w.r.t. their actual strand (i.e., neg strand coords run in reverse)
-            tend = tstart + a.blockSizes[i]
-            (gs,ge) = psl2gff(a.tSize, tstart, tend, a.strand)
-            part = gff3.Feature([
-                a.tName,
-                "BlatAlignment",
-                "match_part",
-                gs,
-                ge,
-                ".",
-                a.strand,
-                '.',
-                {
-                    'ID'    : idMaker.next("match_part"),
-                    'Parent': [ aid ],
-                    'qName' : a.qName
-                }
-               ])
-            yield part
+        pids = [ idMaker.next("match_part") for t in a.tStarts ]
+        for f in alignmentToGff(a, aid, pids):
+            yield f
 
+# Returns the gff3 features for one alignment: the match (with ID aid), followed by one
+# match_part per block (with IDs from pids).
+def alignmentToGff(a, aid, pids):
+    # for notes on converting between psl and gff coordinates see: http://genome.ucsc.edu/FAQ/FAQformat.html#format2
+    (gs,ge) = psl2gff(a.tSize, a.tStart, a.tEnd, "+") # the alignment coords are always w.r.t + strand
+    root = gff3.Feature([
+            a.tName,
+            "BlatAlignment",
+            "match",
+            gs,
+            ge,
+            ".",
+            a.strand,
+            '.',
+            {
+                'ID'    : aid,
+                'Name'  : a.qName,
+                'qName' : a.qName,
+                'matchLen' : a.matchLength(),
+                'pctIdentity' : a.percentIdentity(),
+                'pctLength' : a.percentLength(),
+                'score' : a.score(),
+                'qStart' : a.qStart,
+                'qEnd' : a.qEnd,
+                'qSize' : a.qSize,
+                'matches' : a.matches,
+            }
+           ])
+    feats = [ root ]
+    for i,tstart in enumerate(a.tStarts):
+        # alignment seg coordinates are w.r.t. their actual strand (i.e., neg strand coords run in reverse)
+        tend = tstart + a.blockSizes[i]
+        (gs,ge) = psl2gff(a.tSize, tstart, tend, a.strand)
+        part = gff3.Feature([
+            a.tName,
+            "BlatAlignment",
+            "match_part",
+            gs,
+            ge,
+            ".",
+            a.strand,
+            '.',
+            {
+                'ID'    : pids[i],
+                'Parent': [ aid ],
+                'qName' : a.qName
+            }
+           ])
+        feats.append(part)
+    return feats
 
     
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+#
+# seqcache.py
+#
+# A cache of fasta sequences, kept in two files in the cache directory:
+#       sequences.fa    the sequences (fasta records), appended as they are added
+#       sequences.idx   the index: one line per record, appended after the record is written:
+#                       accession, version, offset, length (tab-separated, like a samtools .fai)
+# The index is read into a dict when the cache is opened, so lookups (and bulk "which of these
+# are cached" queries) need no per-sequence file operations. Records are read from a memory map
+# of sequences.fa.
+#
+# Keys are versioned: records are indexed by accession and version, so NM_001234.2 and
+# NM_001234.3 can both be cached, and each is found by its own id. "NM_001234" (no version)
+# finds the latest version cached (versions compare as numbers). Adding a record for a version
+# that is already cached supersedes the earlier record; compact() rewrites the files without
+# superseded records.
+#
+# If the files are cut short (e.g. a crash while adding), index lines pointing past the end of
+# sequences.fa are ignored. An old-style cache directory (one ACCESSION.fa file per sequence)
+# is imported the first time it is opened.
+#
+# Example:
+#       c = seqcache.SeqCache(dir)
+#       hits, misses = c.partition(ids)
+#       for i in hits:
+#           sys.stdout.write(c.get(i))
+#       c.add(">NM_001234.3 some sequence\nACGT...\n")
+#       c.close()
+#
+#       $ python seqcache.py CACHEDIR compact
+#
+
+import sys
+import os
+import mmap
+import glob
+
+STORE = "sequences.fa"
+INDEX = "sequences.idx"
+TAB = '\t'
+NL = '\n'
+
+#----------------------------------------------------
+# Splits a sequence id into (accession, version). Version is "" if there is none.
+def splitId(ident):
+    acc, dot, version = ident.partition(".")
+    return (acc, version)
+
+# Returns a sort key for a version ("3" -> 3). No version, or a non-numeric one, sorts first.
+def versionKey(version):
+    return int(version) if version.isdigit() else -1
+
+# Returns the id of a fasta record (the header line up to the first whitespace, without the ">").
+def recordId(record):
+    return record[1:record.find(NL)].split()[0]
+
+# Yields the records (strings) from fasta lines.
+def records(lines):
+    rec = []
+    for line in lines:
+        if line.startswith(">") and rec:
+            yield "".join(rec)
+            rec = []
+        rec.append(line)
+    if rec:
+        yield "".join(rec)
+
+#----------------------------------------------------
+class SeqCache:
+    def __init__(self, dir):
+        self.dir = dir
+        self.storeFile = os.path.join(dir, STORE)
+        self.indexFile = os.path.join(dir, INDEX)
+        os.makedirs(dir, exist_ok=True)
+        legacy = not os.path.exists(self.storeFile)
+        self.index = {}         # (accession, version) -> (offset, length)
+        self.latest = {}        # accession -> latest version cached
+        self.nSuperseded = 0
+        self.map = None
+        self.load()
+        self.sfd = open(self.storeFile, 'ab')
+        self.ifd = open(self.indexFile, 'a')
+        if legacy:
+            self.importFiles()
+
+    # Reads the index.
+    def load(self):
+        size = os.path.getsize(self.storeFile) if os.path.exists(self.storeFile) else 0
+        if not os.path.exists(self.indexFile):
+            return
+        with open(self.indexFile) as fd:
+            for line in fd:
+                parts = line.rstrip(NL).split(TAB)
+                if len(parts) != 4:
+                    continue
+                acc, version, offset, length = parts
+                offset, length = int(offset), int(length)
+                if offset + length > size:
+                    continue
+                self.setIndex(acc, version, offset, length)
+
+    # Makes (offset, length) the index entry for acc, version.
+    def setIndex(self, acc, version, offset, length):
+        if (acc, version) in self.index:
+            self.nSuperseded += 1
+        self.index[(acc, version)] = (offset, length)
+        v = self.latest.get(acc, None)
+        if v is None or versionKey(version) >= versionKey(v):
+            self.latest[acc] = version
+
+    # Imports the sequences of an old-style cache (one ACCESSION.fa file per sequence).
+    def importFiles(self):
+        files = glob.glob(os.path.join(self.dir, "*.fa"))
+        files = [f for f in files if os.path.basename(f) != STORE]
+        for f in files:
+            with open(f) as fd:
+                for rec in records(fd):
+                    self.add(rec)
+        self.flush()
+
+    # Returns (version, offset, length) for ident, or None if it is not cached.
+    # Without a version, ident means the latest version cached.
+    def lookup(self, ident):
+        acc, version = splitId(ident)
+        if not version:
+            version = self.latest.get(acc, None)
+            if version is None:
+                return None
+        e = self.index.get((acc, version), None)
+        if e is None:
+            return None
+        return (version,) + e
+
+    def __contains__(self, ident):
+        return self.lookup(ident) is not None
+
+    # Returns (ids that are cached, ids that are not), in the order given.
+    def partition(self, ids):
+        hits = []
+        misses = []
+        for i in ids:
+            (hits if self.lookup(i) else misses).append(i)
+        return (hits, misses)
+
+    # Returns the record (a string) for ident, or None.
+    def get(self, ident):
+        e = self.lookup(ident)
+        if e is None:
+            return None
+        version, offset, length = e
+        if self.map is None or offset + length > len(self.map):
+            self.flush()
+            if self.map is not None:
+                self.map.close()
+            with open(self.storeFile, 'rb') as fd:
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset+length].decode('utf-8')
+
+    # Adds a fasta record (a string, starting with its header line).
+    def add(self, record):
+        if not record.endswith(NL):
+            record += NL
+        acc, version = splitId(recordId(record))
+        data = record.encode('utf-8')
+        offset = self.sfd.tell()
+        self.sfd.write(data)
+        self.setIndex(acc, version, offset, len(data))
+        self.ifd.write(TAB.join([acc, version, str(offset), str(len(data))]) + NL)
+
+    # Writes out buffered additions (sequences first, then the index).
+    def flush(self):
+        self.sfd.flush()
+        self.ifd.flush()
+
+    # Rewrites the files with only the current record for each accession and version.
+    def compact(self):
+        self.flush()
+        tmpStore = self.storeFile + ".tmp"
+        tmpIndex = self.indexFile + ".tmp"
+        index = {}
+        with open(self.storeFile, 'rb') as ifd, open(tmpStore, 'wb') as ofd, open(tmpIndex, 'w') as xfd:
+            for (acc, version), (offset, length) in sorted(self.index.items(), key=lambda x: x[1][0]):
+                ifd.seek(offset)
+                data = ifd.read(length)
+                index[(acc, version)] = (ofd.tell(), length)
+                xfd.write(TAB.join([acc, version, str(ofd.tell()), str(length)]) + NL)
+                ofd.write(data)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.sfd.close()
+        self.ifd.close()
+        os.replace(tmpStore, self.storeFile)
+        os.replace(tmpIndex, self.indexFile)
+        self.sfd = open(self.storeFile, 'ab')
+        self.ifd = open(self.indexFile, 'a')
+        removed = self.nSuperseded
+        self.index = index
+        self.nSuperseded = 0
+        return removed
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.sfd.close()
+        self.ifd.close()
+
+#
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[2] != "compact":
+        sys.stderr.write("Usage: python %s CACHEDIR compact\n" % sys.argv[0])
+        sys.exit(1)
+    c = SeqCache(sys.argv[1])
+    n = c.compact()
+    c.close()
+    sys.stderr.write("Removed %d superseded records. %d sequences cached.\n" % (n, len(c.index)))
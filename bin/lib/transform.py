@@ -0,0 +1,193 @@
+#
+# transform.py
+#
+# Declarative per-feature transforms for the provider prep scripts.
+#
+# The feature-level tweaks a prep does (drop feature types and sources, rename types, set
+# the source column, drop attributes, set curie and so_term_name on top-level features, ...)
+# are written as a rule set (a dict, see below). A rule set is compiled once into a
+# Transformer, which parses and transforms raw gff3 lines in a single pass:
+#   - features of excluded types or sources are rejected from their raw columns, before
+#     column 9 is parsed;
+#   - per type, the new type and the set of attributes to drop are looked up in a table
+#     (built the first time each type is seen);
+#   - dropped attributes are skipped while column 9 is parsed, and so are never unquoted
+#     or stored. (Attributes that the rules read are dropped after the rules are applied.)
+# Structural changes (that need the assembled model) remain in the prep scripts.
+#
+# Rule set keys (all optional):
+#   source              value for column 2
+#   stripSeqidPrefix    prefix removed from column 1 (e.g. "chr")
+#   excludeTypes        types (column 3) of features to drop
+#   excludeSources      sources (column 2) of features to drop
+#   renameTypes         { type -> new type }
+#   dropAttributes      names of attributes to remove from every feature
+#   dropAttributesByType  { (new) type -> names of attributes to remove from features of that type }
+#   copyAttributes      list of { "to" : name, "from" : name, "type" : t, "idPrefix" : p }.
+#                       Sets attribute "to" to the value of attribute "from", if present, for
+#                       features of type t (if given) whose ID starts with p (if given).
+#   rootCurie           { "from" : name, "pattern" : regex, "format" : fmt }. For top-level
+#                       features (no Parent): matches the regex against each value of attribute
+#                       "from". If exactly one matches, sets curie to fmt % (the regex's group 1).
+#   rootSoTerm          { "from" : name, "map" : { value -> so term }, "types" : { value -> type } }.
+#                       For top-level features with attribute "from": sets so_term_name to the
+#                       value (mapped through "map", if there), and the type (if in "types").
+#
+# Example:
+#       t = transform.compile({ "source" : "XYZ", "excludeTypes" : ["region"], "dropAttributes" : ["Note"] })
+#       for f in t.iterate(sys.stdin):
+#           ...
+#
+
+import re
+from gff3 import Feature, ParseError, unquote, TAB, NL, SEMI, EQ, COMMA, HASH, MULTIVALUED, WSP_RE
+
+PCT = '%'
+
+#----------------------------------------------------
+class Transformer:
+    def __init__(self, rules):
+        self.rules = rules
+        self.source = rules.get("source", None)
+        self.stripSeqidPrefix = rules.get("stripSeqidPrefix", None)
+        self.excludeTypes = frozenset(rules.get("excludeTypes", []))
+        self.excludeSources = frozenset(rules.get("excludeSources", []))
+        self.renameTypes = dict(rules.get("renameTypes", {}))
+        self.copyAttributes = list(rules.get("copyAttributes", []))
+        self.rootCurie = rules.get("rootCurie", None)
+        if self.rootCurie:
+            self.curieRe = re.compile(self.rootCurie["pattern"])
+        self.rootSoTerm = rules.get("rootSoTerm", None)
+        # attributes the rules read. If dropped, they are dropped after the rules run.
+        self.used = set([c["from"] for c in self.copyAttributes])
+        if self.rootCurie: self.used.add(self.rootCurie["from"])
+        if self.rootSoTerm: self.used.add(self.rootSoTerm["from"])
+        self.dispatch = {}      # type -> (new type, parse drop set, deferred drops, copies), or None if excluded
+        self.excluded = {}      # type (or source) -> number of features excluded
+
+    # Returns the dispatch entry for (original) type tp.
+    def compileType(self, tp):
+        if tp in self.excludeTypes:
+            d = None
+        else:
+            ntp = self.renameTypes.get(tp, tp)
+            drops = set(self.rules.get("dropAttributes", [])) | set(self.rules.get("dropAttributesByType", {}).get(ntp, []))
+            copies = [(c["to"], c["from"], c.get("idPrefix", None)) for c in self.copyAttributes if c.get("type", ntp) == ntp]
+            d = (ntp, frozenset(drops - self.used), list(drops & self.used), copies)
+        self.dispatch[tp] = d
+        return d
+
+    # Counts an excluded feature.
+    def exclude(self, key):
+        self.excluded[key] = self.excluded.get(key, 0) + 1
+
+    # Parses column 9, skipping the attributes in drops.
+    def parseColumn9(self, value, drops):
+        c9 = {}
+        if value == ".":
+            return c9
+        for t in value.split(SEMI):
+            tt = t.split(EQ)
+            if len(tt) != 2:
+                if WSP_RE.match(t):
+                    continue
+                raise ParseError("Bad column 9 format near '%s'."%t)
+            n = tt[0].strip()
+            if PCT in n: n = unquote(n)
+            if n in drops:
+                continue
+            v = tt[1].strip()
+            if PCT in v:
+                v = [unquote(x) for x in v.split(COMMA)]
+            else:
+                v = v.split(COMMA)
+            if len(v) == 1 and not n in MULTIVALUED:
+                v = v[0]
+            c9[n] = v
+        return c9
+
+    # Parses and transforms one gff3 line (not a comment). Returns the feature,
+    # or None if it is excluded.
+    def parse(self, line):
+        cols = line.split(TAB)
+        if len(cols) != 9:
+            raise ParseError("Wrong number of columns (%d)\n%s" % (len(cols),line))
+        tp = cols[2]
+        d = self.dispatch.get(tp, False)
+        if d is False:
+            d = self.compileType(tp)
+        if d is None:
+            self.exclude(tp)
+            return None
+        if cols[1] in self.excludeSources:
+            self.exclude(cols[1])
+            return None
+        c9 = cols[8]
+        if c9[-1:] == NL:
+            c9 = c9[:-1]
+        cols[8] = self.parseColumn9(c9, d[1])
+        f = Feature.__new__(Feature)
+        list.__init__(f, cols)
+        if f[3] != ".": f[3] = int(f[3])
+        if f[4] != ".": f[4] = int(f[4])
+        return self.apply(f, d)
+
+    # Transforms an already parsed feature. Returns it, or None if it is excluded.
+    def transform(self, f):
+        tp = f[2]
+        d = self.dispatch.get(tp, False)
+        if d is False:
+            d = self.compileType(tp)
+        if d is None:
+            self.exclude(tp)
+            return None
+        if f[1] in self.excludeSources:
+            self.exclude(f[1])
+            return None
+        for n in d[1]:
+            f[8].pop(n, None)
+        return self.apply(f, d)
+
+    # Applies the rules to feature f, given its dispatch entry, d.
+    def apply(self, f, d):
+        ntp, parseDrops, deferredDrops, copies = d
+        attrs = f[8]
+        if self.stripSeqidPrefix and f[0].startswith(self.stripSeqidPrefix):
+            f[0] = f[0][len(self.stripSeqidPrefix):]
+        if self.source:
+            f[1] = self.source
+        f[2] = ntp
+        for (to, frm, idPrefix) in copies:
+            if frm in attrs and (idPrefix is None or attrs.get("ID", "").startswith(idPrefix)):
+                attrs[to] = attrs[frm]
+        if "Parent" not in attrs:
+            rc = self.rootCurie
+            if rc:
+                vs = attrs.get(rc["from"], [])
+                if type(vs) is str: vs = [vs]
+                ms = [m for m in map(self.curieRe.match, vs) if m]
+                if len(ms) == 1:
+                    attrs["curie"] = rc["format"] % ms[0].group(1)
+            rs = self.rootSoTerm
+            if rs:
+                v = attrs.get(rs["from"], None)
+                if v:
+                    f[2] = rs.get("types", {}).get(v, f[2])
+                    attrs["so_term_name"] = rs.get("map", {}).get(v, v)
+        for n in deferredDrops:
+            attrs.pop(n, None)
+        return f
+
+    # Yields the transformed features from the lines of source (skipping comments and blank lines).
+    def iterate(self, source):
+        for line in source:
+            if line.startswith(HASH) or not line.strip():
+                continue
+            f = self.parse(line)
+            if f is not None:
+                yield f
+
+#----------------------------------------------------
+# Compiles a rule set into a Transformer.
+def compile(rules):
+    return Transformer(rules)
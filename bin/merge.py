@@ -3,9 +3,22 @@
 #
 # Merges models into the MGI gene.
 # 
-#       $ python merge.py mgifile providerfile1 [providerfile2 ...]
+#       $ python merge.py [-s statsfile] [-c cachefile] [-v N] mgifile providerfile1 [providerfile2 ...]
 #
-# First file must be the file output by mgiPrep.py
+# With -c, the merge is incremental: genes whose MGI line and provider models are unchanged
+# since the run that wrote cachefile are copied from it rather than merged again (see
+# ModelMerger.mergeIncremental). The cache file is then rewritten for the next run.
+#
+# Statistics for the run (counts per outcome, providers per gene, window sizes, and time
+# spent in each phase) are written as JSON to statsfile, if given.
+# Verbosity (-v, default MERGE_VERBOSITY or 1) controls the messages written to stderr:
+#       0 - only the summary lines
+#       1 - one line per noteworthy event (orphan models, dangling xrefs, missing genes, ...)
+#       2 - as 1, plus the full features involved
+#
+# First file must be the file output by mgiPrep.py, or the index built from it by
+# lib/mgiindex.py (a file ending in ".idx"). With an index, only the MGI genes on the
+# chromosome being merged are loaded.
 #
 # Provider files must contain data for a single chromosome (and all must be the same chromosome!)
 #
@@ -19,24 +32,87 @@
 #
 
 from lib import gff3
+from lib import mgiindex
 import sys
+import os
 import types
+import re
+import time
+import json
+import pickle
+import hashlib
+import argparse
+from collections import deque
 
+# Models are held in the window until the current position is this far (bp) past their end,
+# or the largest model span seen so far on the chromosome, whichever is smaller.
 WINDOWSIZE = 200000
+# Ceiling on the number of features held in the window. Above it, models are flushed as
+# soon as the current position passes their end (after which nothing can merge into them).
+MAXFEATURES = int(os.environ.get("MERGE_MAX_FEATURES") or 250000)
+# Default message verbosity (see above).
+VERBOSITY = int(os.environ.get("MERGE_VERBOSITY") or 1)
+
+# For picking attributes out of raw column 9 text (see pruneOrphans).
+CURIE_RE  = re.compile(r'(?:^|;)curie=([^;\n]*)')
+ID_RE     = re.compile(r'(?:^|;)ID=([^;\n]*)')
+PARENT_RE = re.compile(r'(?:^|;)Parent=([^;\n]*)')
 
 class ModelMerger:
-    def __init__(self, wsize=WINDOWSIZE):
+    def __init__(self, wsize=WINDOWSIZE, maxFeatures=MAXFEATURES, verbosity=VERBOSITY):
         self.idMaker = gff3.IdMaker()
         self.seqid = None
-        self.window = []
+        self.window = deque()
+        self.windowIndex = {}   # MGI curie -> model in self.window
         self.outputMgi = set()
         self.windowSize = wsize
+        self.maxFeatures = maxFeatures
+        self.nFeatures = 0      # number of features currently in the window
+        self.peakFeatures = 0
+        self.nPressureFlushes = 0
+        self.spanSeqid = None
+        self.maxSpan = 0        # largest provider model span seen on spanSeqid
+        self.verbosity = verbosity
+        self.maxWindow = 0      # max number of models in the window
+        self.outcomes = {}      # outcome -> count
+        self.nProviders = {}    # number of provider models merged into a gene -> count of genes
+        self.orphanCounts = {}  # provider file -> number of orphan models (see pruneOrphans)
+        self.times = dict([(k, 0.0) for k in ["flush", "initModel", "mergeModel", "reassignIDs"]])
+        self.tainted = set()    # MGI curies whose merge depended on the window (not cacheable)
 
     # Message logger
     #
     def log(self, m):
         sys.stderr.write(m)
 
+    # Counts an occurrence of outcome. If verbosity >= 1, logs msg. If verbosity >= 2,
+    # also logs the features in details. (Features are only formatted if they are logged.)
+    def note(self, outcome, msg=None, details=[]):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if msg and self.verbosity >= 1:
+            self.log(msg)
+            if self.verbosity >= 2:
+                for d in details:
+                    self.log(str(d))
+
+    # Returns the stats for this run as a dict (suitable for json).
+    def getStats(self):
+        outcomes = dict(self.outcomes)
+        for n in self.orphanCounts.values():
+            outcomes["orphanModel"] = outcomes.get("orphanModel", 0) + n
+        return {
+            "seqid" : self.seqid,
+            "outcomes" : outcomes,
+            "orphansByFile" : self.orphanCounts,
+            "providersPerGene" : dict([(str(k),v) for (k,v) in sorted(self.nProviders.items())]),
+            "maxWindowModels" : self.maxWindow,
+            "maxModelSpan" : self.maxSpan,
+            "peakWindowFeatures" : self.peakFeatures,
+            "maxWindowFeatures" : self.maxFeatures,
+            "earlyFlushes" : self.nPressureFlushes,
+            "seconds" : dict([(k, round(v, 3)) for (k,v) in self.times.items()]),
+        }
+
     # Propagates each gene_id to all features in the gene.
     # Propagates transcript_id to all features in the transcript.
     #
@@ -54,6 +130,11 @@ class ModelMerger:
 
     #
     def reassignIDs(self, m):
+        t0 = time.perf_counter()
+        self._reassignIDs(m)
+        self.times["reassignIDs"] += time.perf_counter() - t0
+
+    def _reassignIDs(self, m):
         self.idMap = {}
         self.idCounts = {}
         feats = gff3.flattenModel(m)
@@ -80,35 +161,87 @@ class ModelMerger:
             if "Derives_from" in f.attributes:
                 f.Derives_from = self.idMap[f.Derives_from]
 
-    #
+    # Tracks the largest provider model span on the current chromosome. This sets
+    # how far past a model's end the window keeps it (see flush).
+    def observe(self, f):
+        if f.seqid != self.spanSeqid:
+            self.spanSeqid = f.seqid
+            self.maxSpan = 0
+        self.maxSpan = max(self.maxSpan, f.end - f.start + 1)
+
+    # Adds n to the count of features in the window (and to model m's count).
+    def countFeatures(self, m, n):
+        m.__dict__["nFeatures"] = m.__dict__.get("nFeatures", 0) + n
+        self.nFeatures += n
+        self.peakFeatures = max(self.peakFeatures, self.nFeatures)
+
+    # Removes and returns models from the front of the window that are done, given
+    # that the next model is f (or all of them, if f is None).
     def flush(self, f=None):
+        t0 = time.perf_counter()
         flushed = []
+        margin = min(self.windowSize, self.maxSpan)
         while len(self.window):
             m = self.window[0]
-            if f and f.seqid == m.seqid and f.start - m.end < self.windowSize:
-                break
+            if f and f.seqid == m.seqid and f.start - m.end < margin:
+                if self.nFeatures <= self.maxFeatures or f.start <= m.end:
+                    break
+                # Over the limit. Flush early. This is safe because inputs are sorted,
+                # so nothing from here on can overlap m.
+                self.nPressureFlushes += 1
             flushed.append(m)
-            self.window.pop(0)
+            self.window.popleft()
+            del self.windowIndex[m.curie]
+            self.nFeatures -= m.nFeatures
 
         for m in flushed:
             self.propagatePartIds(m)
             self.reassignIDs(m)
             self.outputMgi.add(m.curie)
-            for xr in m.Dbxref:
-                if xr not in m._merged:
-                    self.log("Dangling xref %s in gene %s\n" % (xr, m.curie))
+            self.note("outputGene")
+            n = len(m._merged)
+            self.nProviders[n] = self.nProviders.get(n, 0) + 1
+            if "biotypeConflict" in m.attributes:
+                self.note("biotypeConflict")
+            dangling = [xr for xr in m.Dbxref if xr not in m._merged]
+            for xr in dangling:
+                self.note("danglingXref", "Dangling xref %s in gene %s\n" % (xr, m.curie))
+            # kept for the merge cache (see mergeIncremental)
+            m.__dict__["nMerged"] = n
+            m.__dict__["dangling"] = dangling
             m.attributes.pop("_merged", None)
 
+        self.times["flush"] += time.perf_counter() - t0
         return flushed
 
+    # Returns the features of provider model m (root first), ready to be grafted
+    # into a merged model. If copy is False, the features themselves are returned (moved);
+    # they are cross referenced again so that the result has the same shape and
+    # child order as a copy. Copying is only needed when m goes into more than one MGI gene.
+    def detachModel (self, m, copy=True):
+        feats = gff3.flattenModel(m)
+        if copy:
+            return gff3.copyModel(feats)
+        gff3.crossReference(feats)
+        return feats
+
     # Initializes a model for the current window. Injects MGI gene information into 
     # the root nodes of a provider model.
-    def initModel (self, m, mgiGene):
+    def initModel (self, m, mgiGene, copy=True):
+        t0 = time.perf_counter()
+        m = self._initModel(m, mgiGene, copy)
+        self.times["initModel"] += time.perf_counter() - t0
+        return m
+
+    def _initModel (self, m, mgiGene, copy):
         g = mgiGene
         #
-        m = gff3.copyModel(gff3.flattenModel(m))[0]
+        feats = self.detachModel(m, copy)
+        m = feats[0]
+        self.countFeatures(m, len(feats))
         if m.seqid != mgiGene.seqid:
-            self.log("Warning: chromosome mismatch: Gene=%s, MGI chr=%s, %s chr=%s\n" % (g.curie, g.seqid, m.source, m.seqid))
+            self.tainted.add(g.curie)
+            self.note("chromosomeMismatch", "Warning: chromosome mismatch: Gene=%s, MGI chr=%s, %s chr=%s\n" % (g.curie, g.seqid, m.source, m.seqid))
         #
         self.seqid = m.seqid
 
@@ -136,24 +269,33 @@ class ModelMerger:
     # mgi root feature, and the descendant trees from the provider model are grafted onto
     # the growing mgi tree.
     #
-    # The model hierarchy under f is copied into m, rather than moved, because
+    # The model hierarchy under f is copied into m if copy is True, because
     # of complex (non 1-1) associations among models. (I.e., f may be merged
-    # into more than one m).
+    # into more than one m). Otherwise it is moved.
     #
     # Merging a gene with a pseudogene causes the addition of a biotypeConflict attribute.
     #
-    def mergeModel(self, m, f):
+    def mergeModel(self, m, f, copy=True):
+        t0 = time.perf_counter()
+        m = self._mergeModel(m, f, copy)
+        self.times["mergeModel"] += time.perf_counter() - t0
+        return m
+
+    def _mergeModel(self, m, f, copy):
         # sanity checks:
         if m.seqid != f.seqid or m.strand != f.strand:
-            self.log("Cannot merge because chromosomes or strands disagree.\n%s\n%s\n" % (str(m), str(f)))
+            self.tainted.add(m.curie)
+            self.note("strandMismatch", "Cannot merge because chromosomes or strands disagree: %s %s\n" % (m.curie, f.curie), [m, f])
             return m
         if not m.overlaps(f):
-            self.log("Cannot merge because features do not overlap.\n%s\n%s\n" % (str(m), str(f)))
+            self.tainted.add(m.curie)
+            self.note("noOverlap", "Cannot merge because features do not overlap: %s %s\n" % (m.curie, f.curie), [m, f])
             return m
         #
         m.start = min(m.start, f.start)
         m.end   = max(m.end,   f.end)
-        feats = gff3.copyModel(gff3.flattenModel(f))
+        feats = self.detachModel(f, copy)
+        self.countFeatures(m, len(feats) - 1)
         #
         if ("pseudo" in m.type and "pseudo" not in f.type) \
         or ("pseudo" not in m.type and "pseudo" in f.type): 
@@ -166,6 +308,7 @@ class ModelMerger:
             m.children.add(c)
         #
         m._merged.append(f.curie)
+        self.note("mergedModel")
         return m
 
     # processNext (nonMgi) model m.
@@ -175,37 +318,77 @@ class ModelMerger:
     #   3. The matching MGI gene is in the current window. Model m is merged.
     #   4. The matching MGI gene is not in the window and has not been seen. Initialize new model 
     #      in window for MGI gene + model m.
+    # If m goes to exactly one MGI gene (the usual case), its features are moved rather than copied.
     #
     def processNext(self, m):
-        gs  = self.id2mgiFeat.get(m.curie, [])
-        gs = list(filter(lambda g: g.seqid == m.seqid, gs))
+        gs = self.mgiIndex.lookup(m.seqid, m.curie)
         if len(gs) == 0:
-            self.log("Orphan model: %s \n" % str(m.curie))
+            self.note("orphanModel", "Orphan model: %s \n" % str(m.curie))
             return
+        copy = len(gs) > 1
+        if copy:
+            self.note("modelInMultipleGenes")
         for g in gs:
             if g.curie in self.outputMgi:
-                self.log("MGI gene has already been output: " + str(g))
-                self.log("Detected at: " + str(m))
+                self.tainted.add(g.curie)
+                self.note("geneAlreadyOutput", "MGI gene has already been output: %s. Detected at: %s\n" % (g.curie, m.curie), [g, m])
                 return
-            for mm in self.window:
-                if mm.curie == g.curie:
-                    self.mergeModel(mm, m)
-                    break
+            mm = self.windowIndex.get(g.curie, None)
+            if mm is not None:
+                self.mergeModel(mm, m, copy)
             else:
-               self.window.append(self.initModel(m, g))
+                mm = self.initModel(m, g, copy)
+                self.note("initModel")
+                self.window.append(mm)
+                self.windowIndex[g.curie] = mm
+                self.maxWindow = max(self.maxWindow, len(self.window))
 
+    # Reads a provider file, yielding its lines except those of orphan models, i.e., models 
+    # whose root's curie matches no MGI gene on the root's chromosome. (These would just be
+    # discarded by processNext.) Orphans are recognized from the raw text of the root line,
+    # and the rest of the model is skipped by checking each line's Parent against the IDs
+    # skipped so far, so orphans are never parsed or assembled.
+    # Logs each orphan, and the count for the file.
     #
+    def pruneOrphans(self, providerFile):
+        skipped = set()
+        nOrphans = 0
+        with open(providerFile, 'r') as fd:
+            for line in fd:
+                if line.startswith(gff3.COMMENT_CHAR):
+                    yield line
+                    continue
+                col9 = line[line.rfind(gff3.TAB)+1:]
+                pm = PARENT_RE.search(col9)
+                if pm is None:
+                    cm = CURIE_RE.search(col9)
+                    if cm is None:
+                        yield line
+                        continue
+                    seqid = line[:line.find(gff3.TAB)]
+                    curie = gff3.unquote(cm.group(1))
+                    if len(self.mgiIndex.lookup(seqid, curie)):
+                        yield line
+                        continue
+                    nOrphans += 1
+                    if self.verbosity >= 1:
+                        self.log("Orphan model: %s \n" % curie)
+                elif not skipped or not [pid for pid in pm.group(1).split(gff3.COMMA) if pid in skipped]:
+                    yield line
+                    continue
+                im = ID_RE.search(col9)
+                if im:
+                    skipped.add(im.group(1))
+        self.orphanCounts[providerFile] = nOrphans
+        self.log("Orphan models skipped in %s: %d\n" % (providerFile, nOrphans))
+
+    # Loads the MGI genes. Argument is a file name (see mgiindex.load) or an already
+    # loaded MgiIndex (e.g. one shared by several mergers, see mergeAll.py).
     def loadMgiData (self, mgiFile) :
-        self.mgiFeats = []
-        self.id2mgiFeat = {}
-        for f in gff3.iterate(mgiFile):
-            self.mgiFeats.append(f)
-            for xref in f[8].get('Dbxref',[]):
-                if xref in self.id2mgiFeat:
-                    self.log("WARNING: ID %s associated with multiple genes.\n" % xref)
-                    self.id2mgiFeat[xref].append(f)
-                else:
-                    self.id2mgiFeat[xref] = [f]
+        if isinstance(mgiFile, mgiindex.MgiIndex):
+            self.mgiIndex = mgiFile
+        else:
+            self.mgiIndex = mgiindex.load(mgiFile, self.log)
 
     # Merges the sorted gff files listed on the command line into a single stream,
     # then merges features based on Dbxrefs. Maintains a kind of moving window in the
@@ -213,11 +396,25 @@ class ModelMerger:
     # appended to the queues. Items are removed from the front of the queue when the 
     # current position (start coordinate of the latest input feature) moves beyond 
     # their endpoints. 
+    # If prefetch is True, each provider file is parsed into models by its own process,
+    # concurrently with the merge (see gff3.prefetchModels). mergeAll.py turns it on
+    # when there are cpus to spare.
+    # Orphan models are dropped as the files are read (see pruneOrphans).
     #
-    def merge(self, mgiFile, providerFiles):
+    def merge(self, mgiFile, providerFiles, prefetch=False):
         self.loadMgiData(mgiFile)
-        iters = [gff3.models(x) for x in providerFiles]
+        if prefetch:
+            # orphan counts are kept by the reading processes; have them sent back
+            readModels = lambda x, name: gff3.prefetchModels(x, stats=self.orphanCounts, name=name)
+        else:
+            readModels = lambda x, name: gff3.models(x)
+        iters = [readModels(gff3.iterate(self.pruneOrphans(x)), x) for x in providerFiles]
+        return self.mergeModels(iters)
+
+    # The merge proper, given one (sorted) model iterator per provider.
+    def mergeModels(self, iters):
         for m in gff3.merge(*iters):
+            self.observe(m)
             for mm in self.flush(m):
                 yield mm
             self.processNext(m)
@@ -226,21 +423,213 @@ class ModelMerger:
             yield mm
         #
         self.finalCheck()
+        self.log("Merge window: max model span %d, peak features %d (limit %d), early flushes %d\n"
+            % (self.maxSpan, self.peakFeatures, self.maxFeatures, self.nPressureFlushes))
+
+    # Reads a provider file and splits it into models at the text level, without parsing.
+    # Returns a list of (seqid, start, end, curie, lines), one per model, in file order, where
+    # seqid, start, end, and curie are those of the root (curie is None if the root has none),
+    # and lines are the model's lines, in file order.
+    #
+    def scanModels(self, providerFile):
+        models = []
+        id2model = {}
+        with open(providerFile, 'r') as fd:
+            for line in fd:
+                if line.startswith(gff3.COMMENT_CHAR):
+                    continue
+                col9 = line[line.rfind(gff3.TAB)+1:]
+                pm = PARENT_RE.search(col9)
+                if pm is None:
+                    cols = line.split(gff3.TAB, 5)
+                    cm = CURIE_RE.search(col9)
+                    model = (cols[0], int(cols[3]), int(cols[4]), gff3.unquote(cm.group(1)) if cm else None, [line])
+                    models.append(model)
+                else:
+                    model = id2model.get(pm.group(1).split(gff3.COMMA)[0], None)
+                    if model is None:
+                        raise RuntimeError("Parent not found (forward reference?) in %s: %s" % (providerFile, line))
+                    model[4].append(line)
+                im = ID_RE.search(col9)
+                if im:
+                    id2model[im.group(1)] = model
+        return models
+
+    # Like merge, but reuses the merged output from a previous run for genes whose inputs
+    # have not changed. Yields the output text, one merged model (ending with "###") at a time.
+    #
+    # Each MGI gene gets a fingerprint: a hash of the MGI gene line, plus the text of every
+    # provider model that goes to the gene, in merge order (salted with the code, see
+    # cacheSalt). The previous run's output for each gene is kept, by MGI curie, with its
+    # fingerprint, in cacheFile. Genes whose fingerprint matches are written from the cache,
+    # and their provider models are never parsed; only the rest are merged. A gene is only
+    # reused if all its provider models can be skipped, i.e., if a model goes to several
+    # genes, either all of them are reused or none is. Genes whose merge logged a problem
+    # (other than dangling xrefs) are not cached, so that the problem is logged every time.
+    # At the end, cacheFile is replaced with the cache for this run.
+    #
+    def mergeIncremental(self, mgiFile, providerFiles, cacheFile, prefetch=False):
+        self.loadMgiData(mgiFile)
+        salt = cacheSalt()
+        prevCache = loadCache(cacheFile, salt)
+        #
+        # scan the provider files. Find the genes for each model, and the models for each gene.
+        fileModels = [self.scanModels(x) for x in providerFiles]
+        genesOf = {}    # (file index, model index) -> MGI curies
+        gene2keys = {}  # MGI curie -> sorted list of (sort key, file index, model index, gene index)
+        curie2gene = {} # MGI curie -> MGI gene
+        for i, models in enumerate(fileModels):
+            nOrphans = 0
+            for j, (seqid, start, end, curie, lines) in enumerate(models):
+                self.seqid = self.seqid or seqid
+                # the window margin must be what it would be if all models were merged
+                self.observe(types.SimpleNamespace(seqid=seqid, start=start, end=end))
+                if curie is None:
+                    continue
+                gs = self.mgiIndex.lookup(seqid, curie)
+                if len(gs) == 0:
+                    nOrphans += 1
+                    if self.verbosity >= 1:
+                        self.log("Orphan model: %s \n" % curie)
+                    continue
+                k = gff3.sortKey([seqid, None, None, start])
+                genesOf[(i, j)] = [g.curie for g in gs]
+                for gi, g in enumerate(gs):
+                    curie2gene[g.curie] = g
+                    gene2keys.setdefault(g.curie, []).append((k, i, j, gi))
+            self.orphanCounts[providerFiles[i]] = nOrphans
+            self.log("Orphan models skipped in %s: %d\n" % (providerFiles[i], nOrphans))
+        #
+        # fingerprint the genes, and find the ones that can be reused
+        fingerprints = {}
+        for c, keys in gene2keys.items():
+            keys.sort()
+            h = hashlib.sha1(salt)
+            h.update(str(curie2gene[c]).encode())
+            for (k, i, j, gi) in keys:
+                h.update("".join(fileModels[i][j][4]).encode())
+            fingerprints[c] = h.hexdigest()
+        reuse = set([c for (c, fp) in fingerprints.items() if c in prevCache and prevCache[c][0] == fp])
+        changed = True
+        while changed:
+            changed = False
+            for cs in genesOf.values():
+                if len(cs) > 1 and not reuse.issuperset(cs) and not reuse.isdisjoint(cs):
+                    reuse.difference_update(cs)
+                    changed = True
+        #
+        # reused genes, in order of their first model
+        reused = []
+        for c in sorted(reuse, key=lambda c: gene2keys[c][0]):
+            fp, text, nMerged, dangling = prevCache[c]
+            self.outputMgi.add(c)
+            self.note("reusedGene")
+            self.note("outputGene")
+            self.nProviders[nMerged] = self.nProviders.get(nMerged, 0) + 1
+            for xr in dangling:
+                self.note("danglingXref", "Dangling xref %s in gene %s\n" % (xr, c))
+            reused.append((gene2keys[c][0], c))
+        self.log("Genes reused from %s: %d of %d\n" % (cacheFile, len(reused), len(fingerprints)))
+        #
+        # merge the rest
+        def keptLines(i):
+            for j, model in enumerate(fileModels[i]):
+                cs = genesOf.get((i, j), None)
+                if cs is None and model[3] is not None:
+                    continue    # orphan
+                if cs and reuse.issuperset(cs):
+                    continue    # gene(s) reused
+                for line in model[4]:
+                    yield line
+        if prefetch:
+            readModels = lambda x, name: gff3.prefetchModels(x, name=name)
+        else:
+            readModels = lambda x, name: gff3.models(x)
+        iters = [readModels(gff3.iterate(keptLines(i)), providerFiles[i]) for i in range(len(providerFiles))]
+        newCache = {}
+        ri = 0
+        for m in self.mergeModels(iters):
+            key = gene2keys[m.curie][0]
+            while ri < len(reused) and reused[ri][0] < key:
+                yield prevCache[reused[ri][1]][1]
+                newCache[reused[ri][1]] = prevCache[reused[ri][1]]
+                ri += 1
+            text = "".join([str(f) for f in gff3.flattenModel2(m)]) + "###\n"
+            yield text
+            newCache[m.curie] = (fingerprints[m.curie], text, m.nMerged, m.dangling)
+        for k, c in reused[ri:]:
+            yield prevCache[c][1]
+            newCache[c] = prevCache[c]
+        #
+        for c in self.tainted:
+            newCache.pop(c, None)
+        writeCache(cacheFile, salt, newCache)
 
     # Log any features on the current chromosome in MGI that did not get output.
     def finalCheck (self) :
-        chrFeats = filter(lambda f: f.seqid == self.seqid, self.mgiFeats)
+        chrFeats = self.mgiIndex.genes(self.seqid)
         missingChrFeats = filter(lambda f: f.curie not in self.outputMgi, chrFeats)
         for f in missingChrFeats:
-            self.log("Missing: " + str(f))
+            self.note("missingGene", "Missing: %s %s\n" % (f.curie, f.attributes.get("Name", "")), [f])
         
     # end class ModelMerger
 
 #####
 
+# Returns the salt for merge cache fingerprints: a hash of the code that does the merge,
+# so that a change to the code invalidates the cache.
+def cacheSalt () :
+    h = hashlib.sha1()
+    for fname in [__file__, gff3.__file__]:
+        with open(fname, 'rb') as fd:
+            h.update(fd.read())
+    return h.digest()
+
+# Loads a merge cache file: a pickled tuple (salt, { MGI curie -> (fingerprint, text,
+# number of provider models, dangling xrefs) }). Returns the dict, or an empty one if
+# the file does not exist or was written with a different salt.
+def loadCache (cacheFile, salt) :
+    if not os.path.exists(cacheFile):
+        return {}
+    with open(cacheFile, 'rb') as fd:
+        fsalt, cache = pickle.load(fd)
+    return cache if fsalt == salt else {}
+
+# Writes a merge cache file (see loadCache). Written to a temporary file, then renamed.
+def writeCache (cacheFile, salt, cache) :
+    tmp = cacheFile + ".tmp"
+    with open(tmp, 'wb') as fd:
+        pickle.dump((salt, cache), fd, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cacheFile)
+
+# Merges the provider files for one chromosome and writes the merged models to ofd.
+# If statsFile is given, writes the run's stats to it as JSON.
+# If cacheFile is given, merges incrementally (see ModelMerger.mergeIncremental).
+def main (mgiFile, providerFiles, ofd, prefetch=False, statsFile=None, verbosity=VERBOSITY, cacheFile=None) :
+    merger = ModelMerger(verbosity=verbosity)
+    if cacheFile:
+        for text in merger.mergeIncremental(mgiFile, providerFiles, cacheFile, prefetch):
+            ofd.write(text)
+    else:
+        for m in merger.merge(mgiFile, providerFiles, prefetch):
+            for f in gff3.flattenModel2(m):
+                ofd.write(str(f))
+            ofd.write("###\n")
+    if statsFile:
+        with open(statsFile, 'w') as sfd:
+            json.dump(merger.getStats(), sfd, indent=2)
+            sfd.write("\n")
+
+def getArgs () :
+    parser = argparse.ArgumentParser(description='Merge provider models for one chromosome into MGI genes.')
+    parser.add_argument('-s', '--stats', default=None, help='write stats (JSON) to this file')
+    parser.add_argument('-c', '--cache', default=None, help='merge cache file: reuse unchanged genes from it, then update it')
+    parser.add_argument('-v', '--verbosity', type=int, default=VERBOSITY, help='message verbosity (0, 1, or 2)')
+    parser.add_argument('mgifile', help='MGI genes file (mgi.gff or mgi.idx)')
+    parser.add_argument('providerfiles', nargs='*', help='provider files for one chromosome')
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    merger = ModelMerger()
-    for m in merger.merge(sys.argv[1], sys.argv[2:]):
-        for f in gff3.flattenModel2(m):
-            sys.stdout.write(str(f))
-        sys.stdout.write("###\n")
+    args = getArgs()
+    # parse ahead if there are cores to do it
+    main(args.mgifile, args.providerfiles, sys.stdout, (os.cpu_count() or 1) > 1, args.stats, args.verbosity, args.cache)
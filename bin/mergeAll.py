@@ -0,0 +1,117 @@
+#
+# mergeAll.py
+#
+# Runs the merge step (see merge.py) for all chromosomes, in parallel.
+#
+#       $ python mergeAll.py [-d WORKINGDIR] [-w NWORKERS] [-c CACHEDIR] mgifile [chr ...]
+#
+# The MGI genes file (mgi.gff or mgi.idx) is loaded once, then one worker process is
+# forked per chromosome (at most NWORKERS at a time). Workers share the loaded MGI data
+# (copy-on-write). For each chromosome, chr, the worker merges WORKINGDIR/*.chr<chr>.gff
+# into WORKINGDIR/chr<chr>.gff, writes its messages to WORKINGDIR/chr<chr>.merge.log,
+# and its stats (see merge.py) to WORKINGDIR/chr<chr>.stats.json.
+# When all are done, the logs are copied to stderr in chromosome order.
+# With -c, each chromosome is merged incrementally, using (and updating) the cache file
+# CACHEDIR/chr<chr>.merge.cache (see merge.py).
+#
+# If there are at least twice as many cpus as workers, each worker also parses its provider
+# files ahead, in processes of its own (merge.py's prefetch, see gff3.prefetchModels).
+# Otherwise the chromosomes already keep the cpus busy, and parsing ahead would only add
+# the cost of passing the models between processes.
+# If a worker fails, the others are finished, and mergeAll exits with status 1.
+# Chromosomes default to the standard list (gff3.CHRS). Number of workers defaults to
+# the MERGE_WORKERS environment variable; 0 (or unset) means the number of cpus.
+#
+
+import sys
+import os
+import glob
+import argparse
+import multiprocessing
+import multiprocessing.connection
+from lib import gff3
+from lib import mgiindex
+import merge
+
+# The MGI data. Loaded before the workers are forked.
+MGIDATA = None
+
+def log (s) :
+    sys.stderr.write(s)
+
+# Returns the provider files for chromosome c.
+def providerFiles (directory, c) :
+    return sorted(glob.glob(os.path.join(directory, "*.chr%s.gff" % c)))
+
+# Returns the name of the log file for chromosome c.
+def logFile (directory, c) :
+    return os.path.join(directory, "chr%s.merge.log" % c)
+
+# Worker. Merges one chromosome.
+def mergeChromosome (directory, c, cachedir, prefetch) :
+    ofile = os.path.join(directory, "chr%s.gff" % c)
+    lfile = logFile(directory, c)
+    sfile = os.path.join(directory, "chr%s.stats.json" % c)
+    cfile = os.path.join(cachedir, "chr%s.merge.cache" % c) if cachedir else None
+    pfiles = providerFiles(directory, c)
+    with open(ofile, 'w') as ofd, open(lfile, 'w') as lfd:
+        sys.stderr = lfd
+        try:
+            lfd.write("Merging chr%s: %s\n" % (c, " ".join(pfiles)))
+            merge.main(MGIDATA, pfiles, ofd, prefetch=prefetch, statsFile=sfile, cacheFile=cfile)
+        finally:
+            sys.stderr = sys.__stderr__
+
+# Runs the jobs (argument tuples for mergeChromosome), each in its own forked process, at
+# most nworkers at a time. (Not a multiprocessing.Pool: its workers are daemons, and cannot
+# start the prefetch processes.) Returns the jobs that failed.
+def runWorkers (jobs, nworkers) :
+    ctx = multiprocessing.get_context("fork")
+    jobs = list(jobs)
+    running = {}
+    failed = []
+    while jobs or running:
+        while jobs and len(running) < nworkers:
+            job = jobs.pop(0)
+            p = ctx.Process(target=mergeChromosome, args=job)
+            p.start()
+            running[p.sentinel] = (p, job)
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            p, job = running.pop(sentinel)
+            p.join()
+            if p.exitcode != 0:
+                failed.append(job)
+    return failed
+
+def getArgs () :
+    parser = argparse.ArgumentParser(description='Merge provider models into MGI genes, all chromosomes in parallel.')
+    parser.add_argument('-d', '--dir', default='.', help='working directory, containing provider.chrN.gff files')
+    parser.add_argument('-w', '--workers', type=int,
+        default=int(os.environ.get("MERGE_WORKERS") or 0) or os.cpu_count(), help='max number of worker processes')
+    parser.add_argument('-c', '--cachedir', default=None, help='directory of merge cache files (incremental merge)')
+    parser.add_argument('mgifile', help='MGI genes file (mgi.gff or mgi.idx)')
+    parser.add_argument('chrs', nargs='*', default=gff3.CHRS, help='chromosomes to merge')
+    return parser.parse_args()
+
+def main () :
+    global MGIDATA
+    args = getArgs()
+    MGIDATA = mgiindex.load(args.mgifile, log)
+    if isinstance(MGIDATA, mgiindex.MgiIndexFile):
+        MGIDATA.loadAll()
+    workers = max(1, min(args.workers or os.cpu_count(), len(args.chrs)))
+    prefetch = (os.cpu_count() or 1) >= 2 * workers
+    failed = runWorkers([(args.dir, c, args.cachedir, prefetch) for c in args.chrs], workers)
+    for c in args.chrs:
+        lfile = logFile(args.dir, c)
+        if os.path.exists(lfile):
+            with open(lfile, 'r') as fd:
+                for line in fd:
+                    log(line)
+    if failed:
+        log("Merge failed for chromosome(s): %s\n" % " ".join([job[1] for job in failed]))
+        sys.exit(1)
+
+#
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@
 
 import sys
 import re
+import itertools
 from lib import mgiadhoc as db
 from lib import gff3
 from lib import mcv2so
@@ -95,37 +96,52 @@ def smartAlphaKey (a) :
         key.append(ap)
     return key
 
-def main () :
-    # Read the MGI/model id pairs. Build index from MGI id -> list of model ids
+# Reads the MGI/model id pairs. Returns index from MGI id -> list of model ids.
+# (All text columns, so streamed with COPY.)
+def loadModelIds (con) :
     ix = {}
-    for rec in db.sql(mgiModelIds):
-        xref = ldbkey2prefix[rec['_logicaldb_key']] + ':' + rec['modelid']
-        ix.setdefault(rec['mgiid'],[]).append(xref)
-    #
+    for mgiid, modelid, ldbkey in db.copy(mgiModelIds, con):
+        xref = ldbkey2prefix[int(ldbkey)] + ':' + modelid
+        ix.setdefault(mgiid,[]).append(xref)
+    return ix
+
+# Reads the regulates relationships. Returns index from marker key -> list of regulators.
+def loadRegulates (con) :
     rx = {}
-    for rec in db.sql(mgiRegulates):
-        refid = ('PMID:'+rec['pubmedid']) if rec['pubmedid'] else rec['mgiid']
-        t = rec['regulator'] + '[Ref_ID:' + refid + ']'
-        rx.setdefault(rec['_marker_key'],[]).append(t)
+    for mkey, symbol, regulator, pubmedid, refmgiid in db.iterate(mgiRegulates, con):
+        refid = ('PMID:'+pubmedid) if pubmedid else refmgiid
+        t = regulator + '[Ref_ID:' + refid + ']'
+        rx.setdefault(mkey,[]).append(t)
+    return rx
+
+def main () :
+    # The three queries are independent, so they run at the same time, on separate connections:
+    # the model ids and regulates in threads, while the genes query starts here.
+    # With a single connection, the genes query would hold it while waiting for the others,
+    # so they are finished first.
+    fix = db.submit(loadModelIds)
+    frx = db.submit(loadRegulates)
+    if db.POOLSIZE < 2:
+        fix.result()
+        frx.result()
+    genes = db.iterate(mgiGenes)
+    first = next(genes, None)
+    ix = fix.result()
+    rx = frx.result()
     # Read all MGI genes and pseudogenes, and convert them to GFF3.
-    for rec in db.sql(mgiGenes):
+    for rec in itertools.chain([first] if first else [], genes):
       try:
-          mgiid = rec['accid']
-          mkey = rec['_marker_key']
+          mkey, mgiid, symbol, name, markertype, mcvtype, chromosome, genomicchromosome, \
+              startcoordinate, endcoordinate, strand = rec
           if not mgiid in ix:
             # only want things with model ids
             continue
-          symbol = rec['symbol']
-          name = rec['name']
-          chr = rec['genomicchromosome'] if rec['genomicchromosome'] else rec['chromosome']
-          start = '.' if rec['startcoordinate'] is None else int(rec['startcoordinate'])
-          end   = '.' if rec['endcoordinate']   is None else int(rec['endcoordinate'])
-          strand = rec['strand']
+          chr = genomicchromosome if genomicchromosome else chromosome
+          start = '.' if startcoordinate is None else int(startcoordinate)
+          end   = '.' if endcoordinate   is None else int(endcoordinate)
           if strand is None:
             sys.stderr.write("null strand: " + str(rec) + "\n")
             strand = '.'
-          markertype = rec['markertype']
-          mcvtype = rec['mcvtype']
           so_term_name = mcv2so.mcv2so[mcvtype]
           attrs = [
             # mint a B6 strain-specific ID from the MGI ID
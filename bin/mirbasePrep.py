@@ -1,4 +1,3 @@
-
 #
 # mirbase2gff3.py
 #
@@ -17,66 +16,76 @@
 #
 import sys
 import gff3
+import transform
+
+# Feature-level transforms (see lib/transform.py)
+RULES = {
+    "source" : "miRBase",
+    "stripSeqidPrefix" : "chr",
+    "dropAttributes" : [ "Alias" ],
+}
 
-seenIds = set()
-currGene = None
-currTrans = None
+TRANSFORMER = transform.compile(RULES)
 
-for f in gff3.iterate( sys.stdin ):
-    i = f.ID
-    if i in seenIds:
-        sys.stderr.write('DUPLICATE ID (skipped): ')
-        sys.stderr.write(str(f))
-        sys.stderr.write('\n')
-        continue
-    else:
-        seenIds.add(i)
+# Preps the miRBase gff3 lines from inp, writing the results to out (a gff3.ModelSink).
+def prep(inp, out):
+    seenIds = set()
+    currGene = None
+    currTrans = None
 
-    if f[0].startswith('chr'):
-        f[0] = f[0][3:]
-    f[1] = "miRBase"
+    for f in TRANSFORMER.iterate(inp):
+        i = f.ID
+        if i in seenIds:
+            sys.stderr.write('DUPLICATE ID (skipped): ')
+            sys.stderr.write(str(f))
+            sys.stderr.write('\n')
+            continue
+        else:
+            seenIds.add(i)
 
-    f.attributes.pop("Alias", None)
+        if f[2] == "miRNA_primary_transcript":
+            #
+            # Gene feature
+            #
+            g = currGene = gff3.Feature(f)
+            g.ID += "_G"
+            g[2] = 'gene'   # 
+            g.attributes["curie"] = "miRBase:" + f.ID
+            g.attributes["so_term_name"] = "miRNA_gene"
+            out.write(str(g))
+            #
+            # Transcript feature
+            #
+            currTrans = f
+            f[2] = 'pre_miRNA'
+            f.Parent = g.ID
+            f.transcript_id = f.ID
+            out.write(str(f))
+            #
+            # Exon feature
+            #
+            e = gff3.Feature(f)
+            e[2] = 'exon'
+            e.attributes = {}
+            e.ID = f.ID + "_exon"
+            e.Parent = f.ID
+            out.write(str(e))
+        elif f[2] == "miRNA": # per AGR
+            #
+            # miRNA feature
+            #
+            f.Parent = currGene.ID
+            out.write(str(f))
+            #
+            # Exon feature
+            #
+            e = gff3.Feature(f)
+            e[2] = 'exon'
+            e.attributes = {}
+            e.Parent = f.ID
+            e.ID = f.ID + "_exon"
+            out.write(str(e))
 
-    if f[2] == "miRNA_primary_transcript":
-        #
-        # Gene feature
-        #
-        g = currGene = gff3.Feature(f)
-        g.ID += "_G"
-        g[2] = 'gene'   # 
-        g.attributes["curie"] = "miRBase:" + f.ID
-        g.attributes["so_term_name"] = "miRNA_gene"
-        sys.stdout.write(str(g))
-        #
-        # Transcript feature
-        #
-        currTrans = f
-        f[2] = 'pre_miRNA'
-        f.Parent = g.ID
-        f.transcript_id = f.ID
-        sys.stdout.write(str(f))
-        #
-        # Exon feature
-        #
-        e = gff3.Feature(f)
-        e[2] = 'exon'
-        e.attributes = {}
-        e.ID = f.ID + "_exon"
-        e.Parent = f.ID
-        sys.stdout.write(str(e))
-    elif f[2] == "miRNA": # per AGR
-        #
-        # miRNA feature
-        #
-        f.Parent = currGene.ID
-        sys.stdout.write(str(f))
-        #
-        # Exon feature
-        #
-        e = gff3.Feature(f)
-        e[2] = 'exon'
-        e.attributes = {}
-        e.Parent = f.ID
-        e.ID = f.ID + "_exon"
-        sys.stdout.write(str(e))
+#
+if __name__ == "__main__":
+    prep(sys.stdin, gff3.ModelSink(sys.stdout))
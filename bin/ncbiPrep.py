@@ -3,6 +3,8 @@
 #
 # Filters/tweaks the NCBI file.
 # * converts column 1 values from sequence ids to chromosome (or contig) ids.
+# * skips regions (sequences) that are not C57BL/6J or not of interest. These are dropped
+#   from the raw input, without parsing.
 # * filters out unwanted feature types
 # * converts features of type gene where pseudo=true, into features of type pseudogene.
 #   Also converts their transcripts and exon to their pseudogenic cousins.
@@ -18,6 +20,7 @@ import sys
 import os
 import types
 import gff3
+import transform
 import optparse
 
 TAB     = '\t'
@@ -58,12 +61,43 @@ EXCLUDE_TYPES = set([
   "transcriptional_cis_regulatory_region",
 ])
 
+# Feature-level transforms (see lib/transform.py)
+RULES = {
+  "source" : "NCBI",
+  "excludeTypes" : EXCLUDE_TYPES,
+  "renameTypes" : { "lnc_RNA" : "lncRNA" },
+  "rootCurie" : { "from" : "Dbxref", "pattern" : r"GeneID:(.*)", "format" : "NCBI_Gene:%s" },
+  "rootSoTerm" : {
+    "from" : "gene_biotype",
+    "map" : { "protein_coding" : "protein_coding_gene" },
+    "types" : { "pseudogene" : "pseudogene" },
+  },
+  "dropAttributes" : [
+    "gene_biotype",
+    "Dbxref",
+    "gene_synonym",
+    "product",
+    "model_evidence",
+    "gbkey",
+    "gene",
+    "description",
+    "pseudo",
+  ],
+  "dropAttributesByType" : {
+    "exon" : [ "transcript_id", "ncrna_class" ],
+  },
+}
+
 class ConvertNCBI:
-    def __init__(self):
+    # idBase is the starting number for the IDs of inserted transcripts and exons (see
+    # checkPseudogene). Preps that run on separate parts of the file use distinct bases,
+    # so the inserted IDs stay unique (see prepAll.py).
+    def __init__(self, idBase=0):
         self.currentRegionId = None
         self.currentRegion = None
-        self.transcriptCount = 0
-        self.exonCount = 0
+        self.transformer = transform.compile(RULES)
+        self.transcriptCount = idBase
+        self.exonCount = idBase
         
     def getGeneID(self, f):
         ids = f.attributes.get('Dbxref',[])
@@ -76,6 +110,33 @@ class ConvertNCBI:
         return None
 
 
+    # Decides whether we care about the region introduced by region feature f.
+    # Returns the name to use for the region in column 1, or None if the region
+    # is to be skipped.
+    #
+    def regionName(self, f):
+        chr = f.attributes.get('chromosome',None)
+        map = f.attributes.get('map', None)
+        genome = f.attributes.get('genome', None)
+        if f.attributes.get('strain',None) != 'C57BL/6J':
+          # skip anything not on B6
+          return None
+        elif chr == 'Unknown':
+          # unplaced contig
+          return f[0]
+        elif genome == 'genomic':
+          # unlocalized contig
+          return chr + '|' + f[0]
+        elif genome == 'chromosome':
+          # regular ol' chromosome
+          return chr
+        elif genome == 'mitochondrion':
+          # mitochondrion
+          return 'MT'
+        else:
+          # something else
+          return None
+
     # Processes the next feature from the NCBI gff3 file.
     # Returns the feature, or None if the feature should be skipped.
     # (One of the main things this code does is decide which features 
@@ -97,27 +158,7 @@ class ConvertNCBI:
             return None
           # Region with a different ID. See if it's one we care about.
           self.currentRegionId = f[0]
-          chr = f.attributes.get('chromosome',None)
-          map = f.attributes.get('map', None)
-          genome = f.attributes.get('genome', None)
-          if f.attributes.get('strain',None) != 'C57BL/6J':
-            # skip anything not on B6
-            self.currentRegion = None
-          elif chr == 'Unknown':
-            # unplaced contig
-            self.currentRegion = f[0]
-          elif genome == 'genomic':
-            # unlocalized contig
-            self.currentRegion = chr + '|' + f[0]
-          elif genome == 'chromosome':
-            # regular ol' chromosome
-            self.currentRegion = chr
-          elif genome == 'mitochondrion':
-            # mitochondrion
-            self.currentRegion = 'MT'
-          else:
-            # something else
-            self.currentRegion = None
+          self.currentRegion = self.regionName(f)
           return None
         #
         # A feature in the current region
@@ -127,54 +168,69 @@ class ConvertNCBI:
           # don't care about this region
           return None
         #  
-        if f[2] in EXCLUDE_TYPES:
-          return None
-        elif f[2] == "lnc_RNA":
-          f[2] = "lncRNA"
-        #
-        xrs = f.attributes.get('Dbxref', [])
-        if type(xrs) is str:
-            xrs = [xrs]
-
-        #
-        f[0] = self.currentRegion
-        f[1] = "NCBI"
-        if "Parent" not in f.attributes:
-            # set the curie for top level nodes
-            xrs = list(filter(lambda x: x.startswith("GeneID:"), xrs))
-            if len(xrs) == 1:
-                f.attributes["curie"] = xrs[0].replace("GeneID:","NCBI_Gene:")
-            # set the so_term_name for top level nodes
-            biotype = f.attributes.get("gene_biotype", None)
-            if biotype:
-                if biotype == "protein_coding":
-                    biotype += "_gene"
-                elif biotype == "pseudogene":
-                    f[2] = "pseudogene"
-                f.attributes["so_term_name"] = biotype
-        #
-        f.attributes.pop('gene_biotype',None)
-        f.attributes.pop('Dbxref',None)
-        f.attributes.pop('gene_synonym',None)
-        f.attributes.pop('product',None)
-        f.attributes.pop('model_evidence',None)
-        f.attributes.pop('gbkey',None)
-        f.attributes.pop('gene',None)
-        f.attributes.pop('description',None)
-        f.attributes.pop('pseudo',None)
-        if f.type == "exon":
-            f.attributes.pop("transcript_id",None)
-            f.attributes.pop("ncrna_class",None)
+        f = self.transformer.transform(f)
+        if f:
+          f[0] = self.currentRegion
         return f
 
+    # Reads raw lines (bytes) from inp, and yields them (decoded), except those in regions we
+    # don't care about. When a region line introduces a new region, it is parsed and checked
+    # (see regionName). If the region is to be skipped, it and all following lines with the same
+    # column 1 accession (and any comment lines among them) are dropped by comparing bytes,
+    # without being parsed into features.
+    # Logs the number of lines and bytes skipped in each region.
+    #
+    def skipRegions(self, inp):
+        skipPrefix = None       # column 1 (plus tab) of the region being skipped
+        skipped = []            # [ accession, lines, bytes ] per skipped region
+        regionId = None
+        for line in inp:
+            # Comment and blank lines (dropped by pre anyway) don't end a skipped region.
+            if skipPrefix and (line.startswith(skipPrefix) or line.startswith(b'#') or not line.strip()):
+                skipped[-1][1] += 1
+                skipped[-1][2] += len(line)
+                continue
+            skipPrefix = None
+            if not line.startswith(b'#'):
+                cols = line.split(b'\t', 3)
+                if len(cols) > 3 and cols[2] == b'region' and cols[0] != regionId:
+                    regionId = cols[0]
+                    if self.regionName(gff3.Feature(line.decode())) is None:
+                        skipPrefix = cols[0] + b'\t'
+                        skipped.append([cols[0].decode(), 1, len(line)])
+                        continue
+            yield line.decode()
+        if len(skipped):
+            self.log("Skipped regions (accession, lines, bytes):\n")
+            for acc, nlines, nbytes in skipped:
+                self.log("%s\t%d\t%d\n" % (acc, nlines, nbytes))
+            self.log("Total\t%d\t%d\n" % (sum([x[1] for x in skipped]), sum([x[2] for x in skipped])))
+
+    # Yields the features we want from the (binary) lines of inp. Region lines are parsed
+    # and handled by process. Other lines are checked against the current region from their
+    # raw text, then parsed and transformed in one step (see RULES).
+    #
     def pre(self, inp):
         skipped = {}
-        for f in gff3.iterate(inp):
-            if self.process(f):
-               yield f
-            else:
-               n = skipped.get(f.type, 0)
-               skipped[f.type] = n + 1
+        for line in self.skipRegions(inp):
+            if line.startswith(HASH) or not line.strip():
+                continue
+            cols = line.split(TAB, 3)
+            if len(cols) > 3 and cols[2] == 'region':
+                self.process(gff3.Feature(line))
+                skipped['region'] = skipped.get('region', 0) + 1
+                continue
+            if cols[0] != self.currentRegionId:
+                raise RuntimeError('Internal error. Region id mismatch detected.' + line)
+            if self.currentRegion is None:
+                skipped[cols[2]] = skipped.get(cols[2], 0) + 1
+                continue
+            f = self.transformer.parse(line)
+            if f:
+                f[0] = self.currentRegion
+                yield f
+        for t, n in self.transformer.excluded.items():
+            skipped[t] = skipped.get(t, 0) + n
         if len(skipped):
             self.log("Counts of skipped features, by type:\n")
             tps = list(skipped.keys())
@@ -279,14 +335,16 @@ class ConvertNCBI:
                 m.children.remove(c)
 
     #
-    def main(self):
-        for m in gff3.models(self.pre(sys.stdin)):
+    # Preps the NCBI file (binary lines) from inp, writing the models to out (a gff3.ModelSink).
+    def main(self, inp=None, out=None):
+        inp = inp or sys.stdin.buffer
+        out = out or gff3.ModelSink(sys.stdout)
+        for m in gff3.models(self.pre(inp)):
            self.checkMiRnas(m)
            self.checkPseudogene(m)
            self.checkTranscriptNames(m)
            self.noDirectExonChildren(m)
-           for f in gff3.flattenModel(m):
-               print(str(f), end='')
+           out.writeModel(gff3.flattenModel(m))
 
 #
 if __name__ == "__main__":
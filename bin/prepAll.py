@@ -0,0 +1,254 @@
+#
+# prepAll.py
+#
+# Preps a provider's downloaded gff3 file (see ncbiPrep.py, ensemblPrep.py, mirbasePrep.py),
+# in parallel, and writes the results split by chromosome (replaces prep + splitGff.py).
+#
+#       $ python prepAll.py -p PROVIDER [-d WORKINGDIR] [-w NWORKERS] [-t TEMPLATE] [-H HEADERFILE] downloadedfile
+#       $ python prepAll.py -p PROVIDER [-d WORKINGDIR] [-w NWORKERS] [-t TEMPLATE] [-H HEADERFILE] -u URL [-k RAWFILE]
+#
+# Provider files are grouped by sequence (column 1): NCBI by region accession, Ensembl by
+# chromosome. The downloaded file is first scanned (as bytes, without parsing) for the
+# points where column 1 changes, and cut there into shards of whole sequences. Each shard
+# is then prepped by a worker process, which reads its byte range of the file and writes
+# its models, split by chromosome (see gff3.ChrSink), to temporary files. When all are done, the temporary
+# files are combined, in shard order, into WORKINGDIR/TEMPLATE (default PROVIDER.chr%s.gff),
+# and the workers' messages are copied to stderr, in shard order.
+#
+# In pipeline mode (-u), the file is downloaded, decompressed (if gzipped), cut into shards,
+# and prepped in one pass: shards go to the workers as soon as they are cut, and only a few
+# are held in memory at a time. The raw download is saved to RAWFILE (if given), for the
+# record. The header lines (see captureHeader) are written to HEADERFILE, if given.
+#
+# Each NCBI shard starts with a region line, so ConvertNCBI's per-region state is correct.
+# miRBase is not sharded: its prep checks for duplicate IDs across the whole file (and the
+# file is small).
+#
+# Number of workers defaults to the PREP_WORKERS environment variable, or the number of cpus.
+#
+
+import sys
+import os
+import io
+import argparse
+import zlib
+import itertools
+import urllib.request
+import multiprocessing
+import gff3
+import ncbiPrep
+import ensemblPrep
+import mirbasePrep
+
+# Shards are at least this many bytes (except for the last).
+MINSHARDSIZE = 16 * 1024 * 1024
+
+#----------------------------------------------------
+# Prep functions, by provider. Each takes (binary) input lines, an output (gff3.ModelSink),
+# and the shard number.
+#
+def prepNcbi (inp, out, n) :
+    # give each shard its own range of inserted IDs
+    ncbiPrep.ConvertNCBI(n * 1000000).main(inp, out)
+
+def prepEnsembl (inp, out, n) :
+    ensemblPrep.prep(io.TextIOWrapper(inp), out)
+
+def prepMirbase (inp, out, n) :
+    mirbasePrep.prep(io.TextIOWrapper(inp), out)
+
+# provider -> (prep function, can be sharded?)
+PROVIDERS = {
+    "ncbi"    : (prepNcbi, True),
+    "ensembl" : (prepEnsembl, True),
+    "mirbase" : (prepMirbase, False),
+}
+
+#----------------------------------------------------
+# Scans fileName for the byte offsets at which column 1 changes, and returns a list of
+# (offset, length) shards, each of whole sequences and at least minSize bytes (except the last).
+# Comment lines go with the sequence they follow (header lines go with the first).
+#
+def findShards (fileName, minSize) :
+    shards = []
+    start = 0
+    pos = 0
+    prefix = None
+    with open(fileName, 'rb') as fd:
+        for line in fd:
+            if not line.startswith(b'#') and (prefix is None or not line.startswith(prefix)):
+                if prefix is not None and pos - start >= minSize:
+                    shards.append((start, pos - start))
+                    start = pos
+                prefix = line[:line.find(b'\t')+1]
+            pos += len(line)
+    if pos > start:
+        shards.append((start, pos - start))
+    return shards
+
+# Returns the data for a shard, as a (binary) file object. data is either the shard's bytes,
+# or the (file name, offset, length) of its byte range in a file.
+def openShard (data) :
+    if type(data) is bytes:
+        return io.BytesIO(data)
+    fileName, offset, length = data
+    with open(fileName, 'rb') as fd:
+        fd.seek(offset)
+        return io.BytesIO(fd.read(length))
+
+#----------------------------------------------------
+# Pipeline mode: the provider file is read from a URL and prepped as it arrives.
+#
+# Yields the (binary) lines of the file at url. The raw bytes, as received, are also
+# written to keepFile (if given). If the data is gzipped, it is decompressed on the fly.
+# Reads CHUNKSIZE bytes at a time, so memory use is bounded.
+#
+CHUNKSIZE = 1024 * 1024
+
+def streamLines (url, keepFile=None) :
+    kfd = open(keepFile, 'wb') if keepFile else None
+    try:
+        with urllib.request.urlopen(url) as resp:
+            dec = None
+            rest = b''
+            while True:
+                chunk = resp.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                if kfd:
+                    kfd.write(chunk)
+                if dec is None:
+                    gzipped = chunk[:2] == b'\x1f\x8b'
+                    dec = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else False
+                if dec:
+                    data = chunk
+                    chunk = dec.decompress(data)
+                    while dec.eof and dec.unused_data:
+                        # concatenated gzip members
+                        data = dec.unused_data
+                        dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        chunk += dec.decompress(data)
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line + b'\n'
+            if dec:
+                rest += dec.flush()
+            if rest:
+                yield rest
+    finally:
+        if kfd:
+            kfd.close()
+
+# Passes lines through, writing the header lines (comments in the first 100 lines,
+# except gff-version, sequence-region, and ###) to headerFile.
+def captureHeader (lines, headerFile) :
+    with open(headerFile, 'w') as hfd:
+        for i, line in enumerate(lines):
+            if i < 100 and line.startswith(b'#') \
+            and not [x for x in [b'gff-version', b'sequence-region', b'###'] if x in line]:
+                hfd.write(line.decode())
+            yield line
+
+# Cuts a stream of lines into shards (bytes) of whole sequences, like findShards.
+def streamShards (lines, minSize) :
+    buf = []
+    size = 0
+    prefix = None
+    for line in lines:
+        if not line.startswith(b'#') and (prefix is None or not line.startswith(prefix)):
+            if prefix is not None and size >= minSize:
+                yield b''.join(buf)
+                buf = []
+                size = 0
+            prefix = line[:line.find(b'\t')+1]
+        buf.append(line)
+        size += len(line)
+    if size:
+        yield b''.join(buf)
+
+#----------------------------------------------------
+# Worker. Preps one shard into temporary files. Returns (shard number, chromosomes
+# output, in order, messages).
+def prepShard (args) :
+    provider, n, data, tmpTemplate = args
+    prepFcn = PROVIDERS[provider][0]
+    out = gff3.ChrSink(tmpTemplate % (n, "%s"))
+    sys.stderr = io.StringIO()
+    try:
+        prepFcn(openShard(data), out, n)
+        msgs = sys.stderr.getvalue()
+    finally:
+        out.close()
+        sys.stderr = sys.__stderr__
+    return (n, out.chrs, msgs)
+
+def getArgs () :
+    parser = argparse.ArgumentParser(description='Prep a provider file in parallel and split it by chromosome.')
+    parser.add_argument('-p', '--provider', required=True, choices=sorted(PROVIDERS.keys()), help='provider')
+    parser.add_argument('-d', '--dir', default='.', help='output directory')
+    parser.add_argument('-t', '--tmplt', default=None, help='template for naming the output files (default PROVIDER.chr%%s.gff)')
+    parser.add_argument('-w', '--workers', type=int,
+        default=int(os.environ.get("PREP_WORKERS") or 0) or os.cpu_count(), help='max number of worker processes')
+    parser.add_argument('-u', '--url', default=None, help='pipeline mode: download the provider file from this url and prep it as it arrives')
+    parser.add_argument('-k', '--keep', default=None, help='pipeline mode: save the raw download to this file')
+    parser.add_argument('-H', '--header', default=None, help='write the header lines of the provider file to this file')
+    parser.add_argument('file', nargs='?', help='the downloaded provider file (if no url)')
+    args = parser.parse_args()
+    if not (args.url or args.file):
+        parser.error("a file or a url is required")
+    return args
+
+def main () :
+    args = getArgs()
+    workers = max(1, args.workers or os.cpu_count())
+    tmplt = os.path.join(args.dir, args.tmplt or (args.provider + ".chr%s.gff"))
+    tmpTmplt = os.path.join(args.dir, ".%s.shard%%d.%%s.gff" % args.provider)
+    shardable = PROVIDERS[args.provider][1]
+    if args.url:
+        sys.stderr.write("Prepping %s as it downloads\n" % args.url)
+        lines = streamLines(args.url, args.keep)
+        if args.header:
+            lines = captureHeader(lines, args.header)
+        shards = streamShards(lines, MINSHARDSIZE if shardable else float("inf"))
+    else:
+        size = os.path.getsize(args.file)
+        if args.header:
+            with open(args.file, 'rb') as fd:
+                for line in captureHeader(itertools.islice(fd, 100), args.header):
+                    pass
+        if shardable:
+            ranges = findShards(args.file, max(MINSHARDSIZE, size // (4 * workers)))
+        else:
+            ranges = [(0, size)]
+        sys.stderr.write("Prepping %s in %d shard(s)\n" % (args.file, len(ranges)))
+        shards = [(args.file, offset, length) for (offset, length) in ranges]
+    # Shards are handed to the workers as they are cut, with at most 2 per worker pending,
+    # so that (in pipeline mode) the download is only buffered that far ahead.
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    with ctx.Pool(workers) as pool:
+        done = 0
+        for n, data in enumerate(shards):
+            while n - done >= 2 * workers:
+                results[done].wait()
+                done += 1
+            results.append(pool.apply_async(prepShard, [(args.provider, n, data, tmpTmplt)]))
+        results = [r.get() for r in results]
+    # combine the temporary files, in shard order
+    seen = set()
+    for n, chrs, msgs in results:
+        sys.stderr.write(msgs)
+        for c in chrs:
+            tmp = tmpTmplt % (n, c)
+            if c not in seen:
+                seen.add(c)
+                os.replace(tmp, tmplt % c)
+            else:
+                with open(tmplt % c, 'ab') as ofd, open(tmp, 'rb') as ifd:
+                    ofd.write(ifd.read())
+                os.remove(tmp)
+
+#
+if __name__ == "__main__":
+    main()
@@ -7,45 +7,189 @@
 # Usage:
 #       % python seqid2fa.py INFILE OUTFILE
 #
+# Batches are fetched by NWORKERS threads at a time, with requests spaced out by a token
+# bucket to stay within NCBI's allowed rate (3 requests/second, or 10 with an API key).
+# Results are written in batch order, each as soon as it (and the ones before it) are done.
+#
+# If a cache directory is given, sequences are first looked up in the cache there (see
+# lib/seqcache.py), and those fetched are added to it.
+#
+# Progress is recorded in a journal (OUTFILE.journal), so if the fetch fails partway, running
+# it again (with the same input) fetches only the batches not yet done. See Journal.
 #
 
 import sys
 import os
 import types
 import time
+import json
+import shutil
+import hashlib
+import threading
+import concurrent.futures
 import urllib.request, urllib.parse, urllib.error
 import xml.dom.minidom
+import seqcache
 
 # FIXME. Move all these into Configuration and access via os.environ
-FETCHURL  = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+FETCHURL  = os.environ.get('EUTILS_FETCHURL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi')
 BATCHSIZE = 500
+# pause after a failed request (times the number of failures so far)
 SLEEPTIME = 3
 TOOL      = "MGI"
 EMAIL     = "Joel.Richardson@jax.org"
 NTRIES    = 4
+APIKEY    = os.environ.get('NCBI_API_KEY', '')
+# requests per second
+RATE      = 10 if APIKEY else 3
+NWORKERS  = int(os.environ.get('SEQFETCH_WORKERS') or 3)
+
+class FetchError (RuntimeError) :
+    pass
+
+# Token bucket rate limiter. take() waits until a request is allowed: on average rate
+# per second, with bursts of up to burst.
+class TokenBucket :
+    def __init__ (self, rate, burst=1) :
+        self.rate = float(rate)
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take (self) :
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 def log (msg) :
     sys.stderr.write(msg)
     sys.stderr.flush()
 
-cfile = None
-cfd = None
-def processLine (line, yielded, cacheDir) :
-    global cfile
-    global cfd
-    if line.startswith(">"):
-        ident = line.split()[0][1:]
-        identNoV = ident.split(".")[0]
-        yielded.add(ident)
-        yielded.add(identNoV)
-        if cacheDir:
-            cfile = os.path.join(cacheDir, identNoV + '.fa')
-            if cfd:
-                cfd.close()
-            cfd = open(cfile, 'w')
-    if cfd:
-        cfd.write(line)
-    return line
+# Fetches one batch of ids. Returns the lines of the response(s).
+# Tries up to NTRIES times to get the sequences. Provides some protection from intermittant
+# errors from the eUtils server. IDs missing from a response are requested again.
+#
+def fetchBatch (n, idBatch, params, limiter, sleeptime) :
+    params = dict(params)
+    lines = []
+    failures = 0
+    for ntry in range(NTRIES):
+        params['id'] = ",".join(idBatch)
+        if failures:
+            time.sleep(sleeptime * failures)
+        limiter.take()
+        try:
+            log("Fetching sequence batch %s, %d sequences, attempt %d\n" % (n, len(idBatch), ntry+1))
+            fd = urllib.request.urlopen(FETCHURL, urllib.parse.urlencode(params).encode())
+            data = fd.read().decode('utf-8')
+            fd.close()
+        except:
+            # Avoid using word "Error" in log messages unless the script is actually about to fail.
+            msg = str(sys.exc_info()[1]).replace("Error","E-r-r-o-r").replace("error","e-r-r-o-r")
+            log("Unable to open resource: %s\n" % msg)
+            failures += 1
+            continue
+
+        rlines = data.splitlines(True)
+        if not rlines:
+            log("Could not read first line.\n")
+            return lines
+        elif not rlines[0].startswith(">"):
+            log("First line is not a Fasta header: %s\n" % rlines[0])
+            failures += 1
+            continue
+        # success!
+        lines += rlines
+        yielded = set()
+        for line in rlines:
+            if line.startswith(">"):
+                ident = line.split()[0][1:]
+                yielded.add(ident)
+                yielded.add(ident.split(".")[0])
+        # Report IDs that were requested but not in the result
+        # Then try to get the missing ones again
+        missingIds = []
+        for ident in idBatch:
+            if not ident in yielded:
+                missingIds.append(ident)
+        if len(missingIds):
+            log("Response missing %d of %d requested IDs: %s\n" % (len(missingIds), len(idBatch), ",".join(missingIds)))
+            idBatch = missingIds
+            log("Attempting to retrieve %d missing sequences.\n" % len(idBatch))
+            continue
+        else:
+            return lines
+    # if we exhaust the loop, there was an error
+    raise FetchError("Failed to get data from eUtils after %d tries." % NTRIES)
+
+#----------------------------------------------------
+# Checkpoint journal for a fetch, so that a failed run can be resumed. It is a directory with:
+#       journal.log     JSON lines: first, a header with a hash of the input ids and the list
+#                       of ids to fetch (those not in the cache); then, one line per completed
+#                       batch, with its number and the ids of the records received
+#       sequences.*     (if there is no cache dir) a seqcache holding the records received
+# Each batch's records are flushed to the store before its line is written to the log.
+# The journal is removed when the fetch completes.
+#
+class Journal :
+    def __init__ (self, dir, inputHash) :
+        self.dir = dir
+        self.logFile = os.path.join(dir, "journal.log")
+        self.inputHash = inputHash
+        self.fd = None
+
+    # Returns (ids to fetch, { batch number : record ids }) from an existing journal for the
+    # same input, or None.
+    def load (self) :
+        try:
+            with open(self.logFile) as fd:
+                header = json.loads(fd.readline())
+                if header.get("inputHash") != self.inputHash:
+                    return None
+                done = {}
+                for line in fd:
+                    try:
+                        b = json.loads(line)
+                    except ValueError:
+                        # cut short
+                        break
+                    done[b["batch"]] = b["received"]
+                return (header["fetchIds"], done)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # Starts a new journal.
+    def start (self, fetchIds) :
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir)
+        self.fd = open(self.logFile, 'w')
+        self.fd.write(json.dumps({ "inputHash" : self.inputHash, "fetchIds" : fetchIds }) + "\n")
+        self.fd.flush()
+
+    # Continues an existing journal.
+    def resume (self) :
+        self.fd = open(self.logFile, 'a')
+
+    def record (self, n, recordIds) :
+        self.fd.write(json.dumps({ "batch" : n, "received" : recordIds }) + "\n")
+        self.fd.flush()
+
+    def close (self) :
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def remove (self) :
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
 
 def openSequenceFetch(
         ids,
@@ -56,85 +200,134 @@ def openSequenceFetch(
         rettype='fasta',
         batchsize=BATCHSIZE,
         sleeptime=SLEEPTIME,
-        cacheDir=None):
+        cacheDir=None,
+        nworkers=NWORKERS,
+        rate=RATE,
+        journalDir=None):
     # 
-    if cacheDir:
-        os.makedirs(cacheDir, exist_ok=True)
-        #
-        # First yield all sequences currently in the cache
-        ids2 = []
-        for ident in ids:
-            cachefile = os.path.join(cacheDir, ident + '.fa')
-            if os.path.exists(cachefile):
-                fd = open(cachefile, 'r')
-                for line in fd:
-                    yield line
-                fd.close()
-            else:
-                ids2.append(ident)
-        # Now go on and request the remainder from NCBI
-        ids = ids2
+    nworkers = max(1, nworkers)
+    cache = seqcache.SeqCache(cacheDir) if cacheDir else None
+    journal = None
+    done = {}
+    resumed = None
+    if journalDir:
+        journal = Journal(journalDir, hashlib.sha1("\n".join(ids).encode()).hexdigest())
+        resumed = journal.load()
+    if resumed:
+        # Resume: same ids to fetch, and the same batches, as the failed run
+        fetchIds, done = resumed
+        fetchSet = set(fetchIds)
+        hits = [i for i in ids if i not in fetchSet]
+        journal.resume()
+        log("Resuming sequence fetch: %d of %d batches already done.\n"
+            % (len(done), -(-len(fetchIds) // batchsize)))
+    elif cache:
+        hits, fetchIds = cache.partition(ids)
+    else:
+        hits, fetchIds = [], ids
+    if cache:
+        log("%d of %d sequences found in the cache.\n" % (len(hits), len(ids)))
+    if journal and not resumed:
+        journal.start(fetchIds)
+    # Where fetched records are kept (for the journal)
+    store = cache
+    if journal and not cache:
+        store = seqcache.SeqCache(journalDir)
 
     #
-    for i in range(0, len(ids), batchsize):
-
-        idBatch = ids[i:i+batchsize]
-        yielded = set()
-
-        # Get the next batch of ids.
-        params = {
-            'db': db,
-            'retmode' : retmode,
-            'rettype' : rettype,
-            'id' : ",".join(idBatch),
-            'tool' : tool,
-            'email' : email
-        }
-
-        # For each batch, try up to NTRIES time to get the sequences. Provides
-        # some protection from intermittant errors from the eUtils server.
-        for ntry in range(NTRIES):
-            try:
-                time.sleep(sleeptime)
-                log("Fetching sequence batch %d, %d sequences, attempt %d\n" % (i/batchsize, len(idBatch), ntry+1))
-                fd = urllib.request.urlopen(FETCHURL, urllib.parse.urlencode(params).encode())
-            except:
-                # Avoid using word "Error" in log messages unless the script is actually about to fail.
-                msg = str(sys.exc_info()[1]).replace("Error","E-r-r-o-r").replace("error","e-r-r-o-r")
-                log("Unable to open resource: %s\n" % msg)
-                continue
-
-            line = fd.readline().decode('utf-8')
-            if not line:
-                log("Could not read first line.\n")
-                break
-            elif not line.startswith(">"):
-                log("First line is not a Fasta header: %s\n" % line)
-                fd.close()
-                continue
-            # success!
-            yield processLine(line, yielded, cacheDir)
-            for line in fd:
-                yield processLine(line.decode('utf-8'), yielded, cacheDir)
-            fd.close()
-            # Report IDs that were requested but not in the result
-            # Then try to get the missing ones again
-            missingIds = []
-            for ident in idBatch:
-                if not ident in yielded:
-                    missingIds.append(ident)
-            if len(missingIds):
-                log("Response missing %d of %d requested IDs: %s\n" % (len(missingIds), len(idBatch), ",".join(missingIds)))
-                idBatch = missingIds
-                params['id'] = ",".join(idBatch)
-                log("Attempting to retrieve %d missing sequences.\n" % len(idBatch))
-                continue
-            else:
-                break
+    # First yield all sequences currently in the cache. Any that can no longer be read from it
+    # (e.g. on resume, if the cache was changed or cut short since the failed run) are fetched again, below.
+    stale = []
+    for ident in hits:
+        rec = cache.get(ident)
+        if rec is None:
+            stale.append(ident)
         else:
-            # if we exhaust the loop, there was an error
-            log("Failed to get data from eUtils after %d tries.\n" % NTRIES)
+            yield from rec.splitlines(True)
+    if stale:
+        log("%d sequences no longer in the cache. Fetching them again.\n" % len(stale))
+    # Now go on and request the remainder from NCBI
+    params = {
+        'db': db,
+        'retmode' : retmode,
+        'rettype' : rettype,
+        'tool' : tool,
+        'email' : email
+    }
+    if APIKEY:
+        params['api_key'] = APIKEY
+    limiter = TokenBucket(rate)
+    batches = [fetchIds[i:i+batchsize] for i in range(0, len(fetchIds), batchsize)]
+    # Returns the lines of a batch done in an earlier run (from the store), or None if any are missing.
+    def doneLines(n):
+        if n not in done or store is None:
+            return None
+        recs = [store.get(rid) for rid in done[n]]
+        if None in recs:
+            return None
+        return [line for rec in recs for line in rec.splitlines(True)]
+    # Adds the records of a fetched batch to the store, and records the batch in the journal
+    # (unless n is None: a batch of stale cache hits, which are not part of the journal's batches).
+    # Returns its lines.
+    def batchLines(n, lines):
+        if store:
+            rids = []
+            for rec in seqcache.records(lines):
+                store.add(rec)
+                rids.append(seqcache.recordId(rec))
+            if journal and n is not None:
+                store.flush()
+                journal.record(n, rids)
+        return lines
+    # Keep up to 2 batches per worker in flight (so at most that many responses are held).
+    # Yield them in order, each as soon as it is done.
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+        pending = []
+        try:
+            for i in range(0, len(stale), batchsize):
+                pending.append((None, pool.submit(fetchBatch, "stale", stale[i:i+batchsize], params, limiter, sleeptime)))
+            for n, idBatch in enumerate(batches):
+                lines = doneLines(n)
+                if lines is not None:
+                    pending.append((n, lines))
+                else:
+                    pending.append((n, pool.submit(fetchBatch, n, idBatch, params, limiter, sleeptime)))
+                while len(pending) >= 2 * nworkers or (pending and (type(pending[0][1]) is list or pending[0][1].done())):
+                    yield from resultLines(pending.pop(0), batchLines)
+            while pending:
+                yield from resultLines(pending.pop(0), batchLines)
+            if journal:
+                journal.remove()
+                journal = None
+        except FetchError as e:
+            log(str(e) + "\n")
+            # keep what the other batches in flight got
+            for n, f in pending:
+                if type(f) is not list and not f.cancel():
+                    try:
+                        batchLines(n, f.result())
+                    except FetchError:
+                        pass
+            if journal:
+                log("Run again to resume the fetch (journal: %s).\n" % journalDir)
             sys.exit(1)
+        finally:
+            if journal:
+                journal.close()
+            if store is not None and store is not cache:
+                store.close()
+            if cache:
+                # compact when a quarter of the records are superseded versions
+                if cache.nSuperseded > len(cache.index) // 4:
+                    log("Compacting sequence cache: removed %d superseded records.\n" % cache.compact())
+                cache.close()
+
+# Returns the lines of a pending batch: (n, lines) for a batch done earlier, or (n, future).
+def resultLines (item, batchLines) :
+    n, r = item
+    if type(r) is list:
+        return r
+    return batchLines(n, r.result())
 
 def fetchSequences(
         infile,
@@ -162,7 +355,9 @@ def fetchSequences(
     else:
         fd = open(outfile, 'w')
     #
-    for line in openSequenceFetch(ids,tool,email,db,retmode,rettype,batchsize,sleeptime,cacheDir):
+    # A failed fetch can be resumed (if the output is a file). See Journal.
+    journalDir = None if fd is sys.stdout else outfile + ".journal"
+    for line in openSequenceFetch(ids,tool,email,db,retmode,rettype,batchsize,sleeptime,cacheDir,journalDir=journalDir):
         if line[0] == ">":
             seqidv = line[1:].split()[0] # everything after ">" up to the first whitespace char
             seqid = seqidv.split('.')[0]